@@ -0,0 +1,218 @@
+#
+# asyncio counterparts of fftools.  they don't block the event loop, and
+# a child is killed when it is timed out or the task is cancelled.
+#
+import os
+import time
+import json
+import shlex
+import asyncio
+import weakref
+from subprocess import PIPE, DEVNULL
+from tempfile import TemporaryFile
+import fftools
+from fftools import (READ_CHUNK_SIZE, SOCKET_TIMEOUT, metrics,
+                     probe_streams_command, stream_info_steps,
+                     remote_probe_request, remote_probe_result,
+                     records_command)
+
+ASYNC_MAX_PROCS = 32
+
+_async_limiters = weakref.WeakKeyDictionary()
+
+def set_async_limit(nb_procs):
+    """
+    nb_procs: the number of children run at once by the async functions
+    in each event loop.  it is applied to the loops started after that.
+    """
+    global ASYNC_MAX_PROCS
+    ASYNC_MAX_PROCS = nb_procs
+
+def _async_limiter():
+    loop = asyncio.get_running_loop()
+    limiter = _async_limiters.get(loop)
+    if limiter is None:
+        limiter = _async_limiters[loop] = asyncio.Semaphore(ASYNC_MAX_PROCS)
+    return limiter
+
+async def _async_kill(p):
+    if p.returncode is None:
+        try:
+            p.kill()
+        except ProcessLookupError:
+            pass
+    await p.wait()
+
+async def async_probe_streams(input_file, timeout=None, verbose=False):
+    """
+    see fftools.probe_streams().
+    timeout: seconds to wait for ffprobe, or None.  ffprobe is killed,
+        and asyncio.TimeoutError is raised when it is expired.
+    """
+    cmd = probe_streams_command(input_file)
+    if verbose:
+        print("COMMAND:", cmd)
+    async with _async_limiter():
+        t0 = time.perf_counter()
+        p = await asyncio.create_subprocess_exec(
+                *shlex.split(cmd), stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+        try:
+            ff_result, err = await asyncio.wait_for(p.communicate(), timeout)
+        finally:
+            await _async_kill(p)
+            metrics.add_spawn("ffprobe", time.perf_counter() - t0)
+    metrics.count("pipe_bytes", len(ff_result))
+    if err:
+        raise ValueError(err.decode(errors="replace").strip())
+    return ff_result.decode()
+
+async def async_probe_remote(input_file, refresh=False, timeout=None):
+    """
+    see fftools.probe_remote().
+    """
+    if not os.path.exists(fftools.SOCKET_PATH):
+        return remote_probe_result(None)
+    async def ask():
+        reader, writer = await asyncio.open_unix_connection(
+                fftools.SOCKET_PATH)
+        try:
+            writer.write(json.dumps(remote_probe_request(
+                    input_file, refresh=refresh)).encode() + b"\n")
+            await writer.drain()
+            return await reader.readline()
+        finally:
+            writer.close()
+    if timeout is None:
+        timeout = SOCKET_TIMEOUT
+    try:
+        line = await asyncio.wait_for(ask(), timeout)
+        metrics.count("socket_bytes", len(line))
+        res = json.loads(line)
+    except (OSError, ValueError, asyncio.TimeoutError):
+        res = None
+    return remote_probe_result(res)
+
+# the lookups run by a child.  the others read the disk, and are run
+# in the executor of the loop.
+_ASYNC_STEPS = {
+        "probe_remote": async_probe_remote,
+        "ffprobe": async_probe_streams,
+        }
+
+async def async_get_stream_info(input_file, codec_type=None, timeout=None,
+                                verbose=False):
+    """
+    see fftools.get_stream_info().  the probe cache, the probe service and
+    the native parser are used as well.
+    timeout: see async_probe_streams().
+    """
+    loop = asyncio.get_running_loop()
+    steps = stream_info_steps(input_file, codec_type=codec_type,
+                              verbose=verbose)
+    result = None
+    try:
+        while True:
+            phase, func, kwargs = steps.send(result)
+            if phase in _ASYNC_STEPS:
+                result = await _ASYNC_STEPS[phase](**kwargs, timeout=timeout)
+            else:
+                result = await loop.run_in_executor(
+                        None, lambda: func(**kwargs))
+    except StopIteration as e:
+        return e.value
+
+async def async_iter_records(cmd, section, timeout=None, verbose=False):
+    """
+    see fftools.iter_records().
+    timeout: seconds to wait for each chunk of the output, or None.
+        ffprobe is killed, and asyncio.TimeoutError is raised when it is
+        expired.  ffprobe is killed also when the generator is closed.
+    """
+    if verbose:
+        print("CMD==>", cmd)
+    head = f"{section}|".encode()
+    head_len = len(head)
+    nb_bytes = 0
+    nb_records = 0
+    async with _async_limiter():
+        t0 = time.perf_counter()
+        # stderr goes into a file so that ffprobe is never blocked by it.
+        with TemporaryFile() as errfd:
+            p = await asyncio.create_subprocess_exec(
+                    *shlex.split(cmd), stdin=DEVNULL, stdout=PIPE,
+                    stderr=errfd)
+            try:
+                rest = b""
+                while True:
+                    buf = await asyncio.wait_for(
+                            p.stdout.read(READ_CHUNK_SIZE), timeout)
+                    if not buf:
+                        break
+                    nb_bytes += len(buf)
+                    lines = (rest + buf).split(b"\n")
+                    rest = lines.pop()
+                    for line in lines:
+                        if verbose:
+                            print("COL:", line.decode(errors="replace"))
+                        if not line.startswith(head):
+                            continue
+                        nb_records += 1
+                        yield dict(x.split("=", 1) for x in
+                                   line[head_len:].decode().rstrip("\r")
+                                   .split("|"))
+                if await p.wait():
+                    errfd.seek(0)
+                    print("ERROR: {}".format(
+                            errfd.read().decode(errors="replace").strip()))
+            finally:
+                await _async_kill(p)
+                metrics.add_spawn("ffprobe", time.perf_counter() - t0)
+                metrics.count("pipe_bytes", nb_bytes)
+                metrics.count(f"{section}s", nb_records)
+
+def async_iter_frames(input_file, entries=[], read_intervals=None,
+                      timeout=None, verbose=False):
+    """
+    see fftools.iter_frames(), and async_iter_records() about timeout.
+    """
+    cmd = records_command(input_file, "frame", entries=entries,
+                          read_intervals=read_intervals)
+    return async_iter_records(cmd, "frame", timeout=timeout, verbose=verbose)
+
+def async_iter_packets(input_file, entries=[], read_intervals=None,
+                       timeout=None, verbose=False):
+    """
+    see fftools.iter_packets(), and async_iter_records() about timeout.
+    """
+    cmd = records_command(input_file, "packet", entries=entries,
+                          read_intervals=read_intervals)
+    return async_iter_records(cmd, "packet", timeout=timeout, verbose=verbose)
+
+async def _async_collect(records, max_records):
+    result = []
+    try:
+        async for x in records:
+            result.append(x)
+            if max_records and len(result) == max_records:
+                break
+    finally:
+        await records.aclose()
+    return result
+
+async def async_get_frames(input_file, max_frames=0, entries=[],
+                           read_intervals=None, timeout=None, verbose=False):
+    """
+    see fftools.get_frames(), and async_iter_records() about timeout.
+    """
+    return await _async_collect(async_iter_frames(
+            input_file, entries=entries, read_intervals=read_intervals,
+            timeout=timeout, verbose=verbose), max_frames)
+
+async def async_get_packets(input_file, max_packets=0, entries=[],
+                            read_intervals=None, timeout=None, verbose=False):
+    """
+    see fftools.get_packets(), and async_iter_records() about timeout.
+    """
+    return await _async_collect(async_iter_packets(
+            input_file, entries=entries, read_intervals=read_intervals,
+            timeout=timeout, verbose=verbose), max_packets)
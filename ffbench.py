@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import time
+import shlex
+import socket
+import platform
+import statistics
+from subprocess import PIPE, DEVNULL, run
+from tempfile import TemporaryDirectory
+from fftools import (CACHE_DIR, get_stream_info, iter_frames, iter_packets,
+                     set_probe_cache, set_probe_native, set_probe_remote,
+                     add_metrics_arguments, setup_metrics)
+from ffstat import FrameTable
+import argparse
+
+# name: (size, duration in seconds, GOP size, nb of B frames)
+# the extension of the name is the container.
+FIXTURES = {
+        "short-360p-g12b2.mp4": ("640x360", 10, 12, 2),
+        "short-1080p-g250b0.mkv": ("1920x1080", 10, 250, 0),
+        "short-720p-g60b3.mov": ("1280x720", 10, 60, 3),
+        "long-360p-g60b2.mp4": ("640x360", 120, 60, 2),
+        "long-1080p-g30b0.mkv": ("1920x1080", 60, 30, 0),
+        }
+QUICK_FIXTURES = ["short-360p-g12b2.mp4", "short-1080p-g250b0.mkv"]
+
+def make_fixture(name):
+    """
+    generate a fixture by lavfi testsrc if not exists.
+    the encoding is bitexact and single threaded so that the fixture
+    is the same on every run.
+    """
+    path = os.path.join(opt.fixture_dir, name)
+    if os.path.exists(path):
+        return path
+    size, duration, gop, bf = FIXTURES[name]
+    tmp_path = os.path.join(opt.fixture_dir, f".tmp-{name}")
+    cmd = ("ffmpeg -v error -nostats -y -f lavfi "
+           f"-i testsrc=size={size}:rate=30:duration={duration} "
+           f"-c:v libx264 -preset veryfast -g {gop} -bf {bf} "
+           "-pix_fmt yuv420p -threads 1 "
+           "-fflags +bitexact -flags:v +bitexact "
+           f"{shlex.quote(tmp_path)}")
+    print("===>", cmd)
+    run(shlex.split(cmd), stdin=DEVNULL, check=True)
+    os.rename(tmp_path, path)
+    return path
+
+def timeit(func, repeat):
+    """
+    return the median of the elapsed times and the result of the last run.
+    """
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times), result
+
+def bench_probe(paths, native=False):
+    """
+    files per second probed without the cache.
+    """
+    set_probe_native(native)
+    def probe():
+        for path in paths:
+            get_stream_info(path, codec_type="video")
+    elapsed, r = timeit(probe, opt.repeat)
+    set_probe_native(False)
+    return len(paths) / elapsed
+
+def bench_frames(path):
+    """
+    frames per second parsed from ffprobe -show_frames.
+    """
+    def parse():
+        return sum([1 for x in iter_frames(path, entries=[
+                "key_frame", "pict_type", "pkt_pts_time", "pkt_size"])])
+    elapsed, nb_frames = timeit(parse, opt.repeat)
+    return nb_frames / elapsed
+
+def bench_gop(path):
+    """
+    frames per second of the GOP analysis from the packets.
+    """
+    def analyze():
+        t = FrameTable.from_packets(iter_packets(
+                path, entries=["pts_time", "size", "flags"]))
+        t.gop_durations()
+        t.gop_bytes()
+        return len(t)
+    elapsed, nb_frames = timeit(analyze, opt.repeat)
+    return nb_frames / elapsed
+
+def bench_convert(path, duration):
+    """
+    realtime factor of ffcanon.py.
+    """
+    ffcanon = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "ffcanon.py")
+    with TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, "out.mp4")
+        cmd = [sys.executable, ffcanon, "-f", "-y", "--no-cache",
+               "--scale", "640", "-o", output, path]
+        def convert():
+            p = run(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE,
+                    universal_newlines=True)
+            if p.returncode != 0:
+                raise ValueError(f"ERROR: {p.stderr.strip()}")
+        elapsed, r = timeit(convert, 1)
+    return duration / elapsed
+
+def get_meta():
+    p = run(["ffmpeg", "-version"], stdout=PIPE, stderr=DEVNULL,
+            universal_newlines=True)
+    return {
+            "ts": time.time(),
+            "host": socket.gethostname(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "ffmpeg": p.stdout.split("\n")[0],
+            "repeat": opt.repeat,
+            }
+
+def do_bench():
+    """
+    return a dict of the results.  all values are higher is better.
+    """
+    os.makedirs(opt.fixture_dir, exist_ok=True)
+    names = QUICK_FIXTURES if opt.quick else list(FIXTURES)
+    paths = { name: make_fixture(name) for name in names }
+    # measure ffprobe itself, not the cache.
+    set_probe_cache(None)
+    set_probe_remote(False)
+    results = {}
+    results["probe.files_per_sec"] = bench_probe(list(paths.values()))
+    results["probe_native.files_per_sec"] = bench_probe(
+            list(paths.values()), native=True)
+    for name,path in paths.items():
+        print(f"## {name}")
+        results[f"frames.{name}.fps"] = bench_frames(path)
+        results[f"gop.{name}.fps"] = bench_gop(path)
+        if not opt.no_convert and name.startswith("short"):
+            results[f"convert.{name}.realtime"] = bench_convert(
+                    path, FIXTURES[name][1])
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    show the ratio to the baseline and return the names regressed.
+    """
+    regressions = []
+    name_len = max([len(k) for k in results])
+    print("{} {:>12} {:>12} {:>7}".format("Name".ljust(name_len),
+                                          "Baseline", "Current", "Ratio"))
+    for k,v in results.items():
+        b = baseline.get(k)
+        if not b:
+            print("{} {:>12} {:12.3f}".format(k.ljust(name_len), "-", v))
+            continue
+        ratio = v / b
+        mark = ""
+        if ratio < 1 - threshold:
+            mark = " REGRESSION"
+            regressions.append(k)
+        print("{} {:12.3f} {:12.3f} {:7.3f}{}".format(
+                k.ljust(name_len), b, v, ratio, mark))
+    return regressions
+
+#
+# main
+#
+ap = argparse.ArgumentParser(
+        description="benchmark the tools with the fixtures generated "
+        "by ffmpeg lavfi testsrc.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+ap.add_argument("-o", action="store", dest="output_file",
+                help="specify a file to write the results in JSON.")
+ap.add_argument("--compare", action="store", dest="baseline_file",
+                help="specify the results of a previous run to compare.")
+ap.add_argument("--threshold", action="store", dest="threshold",
+                type=float, default=0.2,
+                help="specify the ratio of the slowdown to be flagged.")
+ap.add_argument("--fixtures", action="store", dest="fixture_dir",
+                default=os.path.join(CACHE_DIR, "bench"),
+                help="specify the directory of the fixtures.")
+ap.add_argument("--repeat", action="store", dest="repeat",
+                type=int, default=3,
+                help="specify the number of runs of each benchmark.")
+ap.add_argument("--quick", action="store_true", dest="quick",
+                help="use only the short fixtures.")
+ap.add_argument("--no-convert", action="store_true", dest="no_convert",
+                help="skip the conversion benchmark.")
+add_metrics_arguments(ap)
+opt = ap.parse_args()
+setup_metrics(opt)
+
+results = do_bench()
+if opt.output_file:
+    with open(opt.output_file, "w") as fd:
+        json.dump({"meta": get_meta(), "results": results}, fd, indent=2)
+if opt.baseline_file:
+    with open(opt.baseline_file) as fd:
+        baseline = json.load(fd)["results"]
+    regressions = compare(results, baseline, opt.threshold)
+    if regressions:
+        print(f"ERROR: {len(regressions)} regression(s) found.")
+        sys.exit(1)
+else:
+    for k,v in results.items():
+        print(f"{k} {v:.3f}")
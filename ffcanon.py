@@ -2,17 +2,76 @@
 
 import sys
 import unicodedata
-from subprocess import Popen, PIPE, DEVNULL
+from subprocess import PIPE, DEVNULL
 import shlex
 import os
-from fftools import (get_stream_info, get_duration,
-                     ffPrintInfo, progress_bar, parse_time)
-import re
+import time
+import shutil
+import threading
+from bisect import bisect_left
+from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor
+from fftools import (get_stream_info, get_duration, iter_packets,
+                     ffPrintInfo, progress_bar, MultiProgress, parse_time,
+                     iter_progress, progress_eta, Telemetry, Manifest,
+                     add_probe_arguments, setup_probe, Process,
+                     measure_quality)
+from ffwatch import Watcher
+from collections import deque
 from datetime import timedelta
 
 _DEFAULT_SCALE = 1280
 
-def do_main(input_file, quoted=False):
+# the encoders and the options to re-encode the boundaries of --smart-cut.
+_SMART_CUT_CODECS = {
+        "h264": ("libx264", "h264_mp4toannexb"),
+        "hevc": ("libx265", "hevc_mp4toannexb"),
+        }
+_X264_PROFILES = {
+        "CBase": "baseline",
+        "Base": "baseline",
+        "Main": "main",
+        "High": "high",
+        "High 10": "high10",
+        "High 4:2:2": "high422",
+        "High 4:4:4 Predictive": "high444",
+        }
+
+def get_output_file(input_file):
+    if opt.output_file is None:
+        bname, prefix = os.path.splitext(input_file)
+        bname = unicodedata.normalize("NFC", bname)
+        if opt.output_dir is not None:
+            bname = os.path.join(opt.output_dir, os.path.basename(bname))
+        return f"{bname}-dst.mp4"
+    else:
+        return opt.output_file
+
+def get_options():
+    """
+    return the options which make a difference in the output,
+    recorded in the manifest.
+    """
+    keys = ["copy_codec", "profile_level", "scale", "rotate",
+            "time_start", "time_end", "time_duration",
+            "no_audio", "force", "copy_bitrate"]
+    if opt.smart_cut:
+        keys.append("smart_cut")
+    if opt.output_seek:
+        keys.append("output_seek")
+    if opt.estimate:
+        keys.extend(["estimate", "candidates", "target_ssim"])
+    return " ".join([ f"{k}={getattr(opt, k)}" for k in keys ])
+
+def make_job(input_file):
+    """
+    return a job to convert the input_file, or None if not needed.
+    """
+    output_file = get_output_file(input_file)
+    if (manifest is not None and not opt.show_profile and
+        manifest.is_done(input_file, output_file, get_options())):
+        print(f"## already converted: {input_file}")
+        return None
     ffinfo = get_stream_info(input_file, codec_type="video",
                               verbose=opt.verbose)[0]
     #
@@ -21,39 +80,37 @@ def do_main(input_file, quoted=False):
     ffprint.print_header()
     ffprint.print_info(ffinfo)
     if opt.show_profile:
-        return
+        return None
     #
     if ffinfo["width"] < 1920 and not opt.force:
         print("no need to resize.")
-        return
+        return None
     #
     nb_frames = int(ffinfo.get("nb_frames","0"))
     #
-    if opt.output_file is None:
-        bname, prefix = os.path.splitext(input_file)
-        bname = unicodedata.normalize("NFC", bname)
-        output_file  = f"{bname}-dst.mp4"
-    else:
-        output_file  = opt.output_file
-    #
     opts = []
-    #opts.append("-progress")
     if opt.overwrite:
         opts.append("-y")
+    elif manifest is not None and manifest.is_partial(input_file, output_file):
+        # redo the conversion interrupted.
+        print("NOTE: overwrite the partial output.")
+        opts.append("-y")
     if opt.no_audio:
         opts.append("-an")
     #
+    # the options of the video, used also for the samples of --estimate.
+    video_opts = []
     if opt.copy_codec:
-        opts.append("-c:v copy")
+        video_opts.append("-c:v copy")
     else:
-        if opt.copy_bitrate:
-            opts.append("-b:v {}".format(ffinfo["bit_rate"]))
+        if opt.copy_bitrate and not opt.estimate:
+            video_opts.append("-b:v {}".format(ffinfo["bit_rate"]))
         else:
-            opts.append("-profile:v high")
+            video_opts.append("-profile:v high")
             if opt.profile_level is not None:
-                opts.append(f"-level:v {opt.profile_level}")
+                video_opts.append(f"-level:v {opt.profile_level}")
             else:
-                opts.append("-level:v {}".format(ffinfo["level"]))
+                video_opts.append("-level:v {}".format(ffinfo["level"]))
     # -vf option
     vf_opt = []
     # -vf: scale
@@ -73,56 +130,649 @@ def do_main(input_file, quoted=False):
             # just ignore it.
             pass
     if len(vf_opt):
-        opts.append("-vf " + ",".join(vf_opt))
+        video_opts.append("-vf " + ",".join(vf_opt))
+    opts.extend(video_opts)
+    base_opts = list(opts)
     # set ripping duration.
     # and, get parameters for progress bar.
+    input_opts = []
     if (opt.time_start is None and opt.time_end is None and
         opt.time_duration is None):
+        time_start = 0
         total_dur = get_duration(ffinfo)
     else:
         if opt.time_start:
-            opts.append(f"-ss {opt.time_start}")
             time_start = parse_time(opt.time_start)
         else:
             time_start = 0
         #
         if opt.time_duration:
             # ignore even if --time-end is specified.
-            opts.append(f"-t {opt.time_duration}")
-            total_dur = time_start + parse_time(opt.time_duration)
+            total_dur = parse_time(opt.time_duration)
         elif opt.time_end:
-            opts.append(f"-to {opt.time_end}")
             total_dur = parse_time(opt.time_end) - time_start
         else:
             total_dur = get_duration(ffinfo) - time_start
+        #
+        if opt.output_seek:
+            # ffmpeg decodes and drops the frames before the start.
+            if opt.time_start:
+                opts.append(f"-ss {opt.time_start}")
+            if opt.time_duration:
+                opts.append(f"-t {opt.time_duration}")
+            elif opt.time_end:
+                opts.append(f"-to {opt.time_end}")
+        else:
+            # ffmpeg seeks the input, then decodes from the key frame
+            # before the start.  the timestamps of the output start
+            # from zero, so -to of the input is passed as -t.
+            if time_start:
+                input_opts.append(f"-ss {time_start}")
+            if opt.time_duration or opt.time_end:
+                opts.append(f"-t {total_dur}")
     #
-    opts = " ".join(opts)
+    job = {
+            "input_file": input_file,
+            "output_file": output_file,
+            "input_opts": " ".join(input_opts),
+            "opts": " ".join(opts),
+            "base_opts": " ".join(base_opts),
+            "video_opts": " ".join(video_opts),
+            "vf": ",".join(vf_opt),
+            "ffinfo": ffinfo,
+            "time_start": time_start,
+            "total_dur": total_dur,
+            }
+    if opt.estimate and not opt.copy_codec:
+        rate_opts = estimate(job)
+        job["opts"] += f" {rate_opts}"
+        job["base_opts"] += f" {rate_opts}"
+    return job
+
+def get_rate_opts(candidate):
+    """
+    return the options of ffmpeg for a candidate of --candidates.
+    a number is for -crf, and a number followed by k or M is for -b:v.
+    """
+    if candidate[-1] in "kKmM":
+        return f"-b:v {candidate}"
+    return f"-crf {candidate}"
 
-    cmd = (f"ffmpeg -i {shlex.quote(input_file)} "
+def estimate(job):
+    """
+    encode the samples of the input with each candidate in parallel,
+    and return the options of the candidate with the lowest bitrate
+    whose SSIM is not less than the target in every sample.
+    """
+    input_file = job["input_file"]
+    duration = opt.sample_duration
+    if opt.nb_samples*duration >= job["total_dur"]:
+        nb_samples = 1
+        duration = job["total_dur"]
+    else:
+        nb_samples = opt.nb_samples
+    step = job["total_dur"] / nb_samples
+    starts = [ job["time_start"] + max(0, step*(i+0.5) - duration/2)
+               for i in range(nb_samples) ]
+    candidates = opt.candidates.split(",")
+    # the indices name the samples, as the values may be the same.
+    tasks = [ (i, c, j, a) for i,c in enumerate(candidates)
+              for j,a in enumerate(starts) ]
+    nb_workers = min(len(tasks), os.cpu_count() or 1)
+    nb_threads = max(1, (os.cpu_count() or 1) // nb_workers)
+    print(f"## estimate from {nb_samples} samples of {duration} sec, "
+          f"{len(candidates)} candidates.")
+    tmpdir = mkdtemp(prefix=".ffcanon-",
+                     dir=os.path.dirname(os.path.abspath(job["output_file"])))
+    def run(task):
+        i, c, j, a = task
+        output_file = os.path.join(tmpdir, f"c{i}-s{j}.mp4")
+        cmd = (f"ffmpeg -v error -y -ss {a} -t {duration} "
+               f"-i {shlex.quote(input_file)} -an {job['video_opts']} "
+               f"{get_rate_opts(c)} -threads {nb_threads} "
+               f"{shlex.quote(output_file)}")
+        if opt.verbose:
+            print("===>", cmd)
+        p = Process(shlex.split(cmd), stdin=DEVNULL, stdout=DEVNULL,
+                    stderr=PIPE, universal_newlines=True)
+        err = p.communicate()[1]
+        if p.returncode != 0:
+            raise ValueError(f"ffmpeg exited with {p.returncode}. "
+                             f"{err.strip()}")
+        q = measure_quality(output_file, input_file,
+                            reference_opts=f"-ss {a} -t {duration}",
+                            reference_vf=job["vf"], verbose=opt.verbose)
+        q["bits"] = os.stat(output_file).st_size*8
+        return q
+    try:
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            results = list(executor.map(run, tasks))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    # summary of each candidate.
+    stats = []
+    for i,c in enumerate(candidates):
+        qs = [ q for task,q in zip(tasks, results) if task[0] == i ]
+        ssim = [ q.get("ssim", 0) for q in qs ]
+        stats.append({
+                "candidate": c,
+                "kbps": sum([q["bits"] for q in qs])/(duration*len(qs))/1000,
+                "min_ssim": min(ssim),
+                "avr_ssim": sum(ssim)/len(ssim),
+                "psnr": sum([q.get("psnr", 0) for q in qs])/len(qs),
+                })
+    print("{:10} {:>10} {:>9} {:>9} {:>6} {:>10}".format(
+            "Candidate", "kbps", "min SSIM", "avr SSIM", "PSNR", "Est. MB"))
+    for x in stats:
+        print("{:10} {:10.1f} {:9.5f} {:9.5f} {:6.2f} {:10.1f}".format(
+                x["candidate"], x["kbps"], x["min_ssim"], x["avr_ssim"],
+                x["psnr"], x["kbps"]*1000*job["total_dur"]/8/1000000))
+    passed = [ x for x in stats if x["min_ssim"] >= opt.target_ssim ]
+    if passed:
+        best = min(passed, key=lambda x: x["kbps"])
+    else:
+        best = max(stats, key=lambda x: x["min_ssim"])
+        print(f"WARNING: no candidate reached SSIM {opt.target_ssim}.")
+    print(f"## picked {best['candidate']}")
+    return get_rate_opts(best["candidate"])
+
+def job_command(job, nb_threads=0):
+    """
+    nb_threads: passed to ffmpeg -threads if not zero.
+    """
+    opts = job["opts"]
+    if nb_threads:
+        opts += f" -threads {nb_threads}"
+    input_opts = job.get("input_opts", "")
+    if input_opts:
+        input_opts += " "
+    return (f"ffmpeg -nostats -progress pipe:1 "
+        f"{input_opts}-i {shlex.quote(job['input_file'])} "
         f"{opts} "
-        f"{shlex.quote(output_file)}")
-    print("===>", cmd)
-    print("Duration:", str(timedelta(seconds=total_dur)))
-    p = Popen(shlex.split(cmd), stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+        f"{shlex.quote(job['output_file'])}")
+
+def run_job(job, progress=None, nb_threads=0):
+    """
+    run ffmpeg of the job.  return True if it succeeded.
+    otherwise, the reason is set into job["error"].
+    progress: called with the job and a dict from iter_progress().
+    """
+    if manifest is not None and not job.get("segment"):
+        manifest.start(job["input_file"], job["output_file"], get_options())
+        result = run_ffmpeg(job, progress=progress, nb_threads=nb_threads)
+        manifest.finish(job["input_file"], result)
+        return result
+    return run_ffmpeg(job, progress=progress, nb_threads=nb_threads)
+
+def run_ffmpeg(job, progress=None, nb_threads=0):
+    cmd = job_command(job, nb_threads=nb_threads)
+    p = Process(shlex.split(cmd), stdin=DEVNULL, stdout=PIPE,
+            stderr=None if opt.verbose else PIPE,
             universal_newlines=True
             )
+    # drain stderr, keeping the last lines for the error message.
+    err_lines = deque(maxlen=10)
+    if p.stderr is not None:
+        err_reader = threading.Thread(target=err_lines.extend,
+                                      args=(p.stderr,), daemon=True)
+        err_reader.start()
+    t0 = time.monotonic()
+    for info in iter_progress(p.stdout):
+        if telemetry is not None:
+            telemetry.write({
+                    "input": job["input_file"],
+                    "output": job["output_file"],
+                    "opts": job["opts"],
+                    "threads": nb_threads,
+                    "elapsed": time.monotonic() - t0,
+                    **info})
+        if progress is not None:
+            progress(job, info)
+    p.wait()
+    if p.stderr is not None:
+        err_reader.join()
+    if p.returncode != 0:
+        if [ x for x in err_lines if "Not overwriting" in x ]:
+            job["error"] = "output filename has exsted."
+        else:
+            job["error"] = "ffmpeg exited with {}. {}".format(
+                    p.returncode, "".join(err_lines).strip())
+        return False
+    return True
 
-    while True:
-        buf = p.stderr.readline()
-        if not buf:
-            break
-        if "Not overwriting" in buf:
-            print("ERROR: output filename has exsted.")
+def do_main(input_file):
+    job = make_job(input_file)
+    if job is not None:
+        convert(job)
+
+def convert(job):
+    print("===>", job_command(job))
+    print("Duration:", str(timedelta(seconds=job["total_dur"])))
+    def progress(job, info):
+        if info["time"] is not None:
+            progress_bar(info["time"], job["total_dur"], width=50,
+                         suffix=progress_eta(info, job["total_dur"]))
+    result = run_job(job, progress=progress)
+    print()
+    if not result:
+        print(f"ERROR: {job['error']}")
+    return result
+
+def get_key_frames(input_file, time_start, time_end, start_time=0.):
+    """
+    return the sorted times of the key frames in [time_start, time_end).
+    it reads only the packets, and stops at time_end.
+    the times are relative to start_time, the start of the file,
+    as the -ss of ffmpeg is.
+    """
+    keys = []
+    read_intervals = (f"{time_start+start_time}%{time_end+start_time}"
+                      if time_start else None)
+    packets = iter_packets(input_file, entries=["pts_time", "flags"],
+                           read_intervals=read_intervals,
+                           verbose=opt.verbose)
+    try:
+        for x in packets:
+            if not x.get("flags", "").startswith("K"):
+                continue
+            try:
+                t = float(x["pts_time"]) - start_time
+            except (KeyError, ValueError):
+                continue
+            if time_start <= t < time_end:
+                keys.append(t)
+            elif t >= time_end:
+                break
+    finally:
+        packets.close()
+    return sorted(keys)
+
+def get_start_time(ffinfo):
+    try:
+        return float(ffinfo.get("start_time", 0))
+    except ValueError:
+        return 0.
+
+def get_split_points(input_file, time_start, time_end, nb_segments,
+                     start_time=0.):
+    """
+    return the times of the key frames nearest to the points dividing
+    the range into nb_segments evenly.
+    """
+    keys = [ t for t in get_key_frames(input_file, time_start, time_end,
+                                       start_time=start_time)
+             if t > time_start ]
+    points = []
+    for i in range(1, nb_segments):
+        if not keys:
             break
-        # frame=  671 fps= 19 q=-1.0 Lsize=   63844kB time=00:06:01.49 bitrate=1446.8kbits/s dup=380 drop=387 speed=0.324x    
+        target = time_start + (time_end - time_start)*i/nb_segments
+        j = bisect_left(keys, target)
+        t = min(keys[max(j-1,0):j+1], key=lambda k: abs(k - target))
+        if not points or t > points[-1]:
+            points.append(t)
+    return points
+
+def do_segmented(input_file, nb_segments):
+    """
+    split the input_file at key frames into nb_segments, convert them
+    in parallel, and join them by the concat demuxer without re-encoding.
+    """
+    job = make_job(input_file)
+    if job is None:
+        return
+    if opt.copy_codec:
+        print("NOTE: segmented encoding is not used with -c.")
+        convert(job)
+        return
+    if (os.path.exists(job["output_file"]) and not opt.overwrite and
+        not (manifest is not None and
+             manifest.is_partial(input_file, job["output_file"]))):
+        print("ERROR: output filename has exsted.")
+        return
+    if manifest is not None:
+        manifest.start(input_file, job["output_file"], get_options())
+    result = convert_segments(job, nb_segments)
+    if manifest is not None:
+        manifest.finish(input_file, result)
+
+def convert_segments(job, nb_segments):
+    """
+    return True if it succeeded.
+    """
+    input_file = job["input_file"]
+    time_start = job["time_start"]
+    time_end = time_start + job["total_dur"]
+    points = get_split_points(input_file, time_start, time_end, nb_segments,
+                              start_time=get_start_time(job["ffinfo"]))
+    bounds = [time_start] + points + [time_end]
+    print(f"## {len(bounds)-1} segments at", ", ".join(
+            [ str(timedelta(seconds=t)) for t in bounds ]))
+    print("Duration:", str(timedelta(seconds=job["total_dur"])))
+    tmpdir = mkdtemp(prefix=".ffcanon-",
+                     dir=os.path.dirname(os.path.abspath(job["output_file"])))
+    try:
+        segs = []
+        for i,(a,b) in enumerate(zip(bounds[:-1], bounds[1:])):
+            segs.append({
+                    "input_file": input_file,
+                    "output_file": os.path.join(tmpdir, f"seg{i:04}.mp4"),
+                    "input_opts": f"-ss {a}",
+                    "opts": f"-y {job['base_opts']} -t {b-a}",
+                    "total_dur": b - a,
+                    "current": 0,
+                    "segment": True,
+                    })
+        nb_threads = max(1, (os.cpu_count() or 1) // len(segs))
         if opt.verbose:
-            print(buf, end="", flush=True)
+            for seg in segs:
+                print("===>", job_command(seg, nb_threads=nb_threads))
+        lock = threading.Lock()
+        def progress(seg, info):
+            with lock:
+                seg["current"] = info["time"] or seg["current"]
+                if info["progress"] == "end":
+                    seg["speed"] = 0
+                else:
+                    seg["speed"] = info["speed"] or 0
+                total = {"time": sum([x["current"] for x in segs]),
+                         "speed": sum([x.get("speed", 0) for x in segs])}
+                progress_bar(total["time"], job["total_dur"], width=50,
+                             suffix=progress_eta(total, job["total_dur"]))
+        with ThreadPoolExecutor(max_workers=len(segs)) as executor:
+            results = list(executor.map(
+                    lambda seg: run_job(seg, progress=progress,
+                                        nb_threads=nb_threads), segs))
+        print()
+        for seg,result in zip(segs, results):
+            if not result:
+                print(f"ERROR: {seg['output_file']}: {seg['error']}")
+                return False
+        # join the segments.
+        list_file = os.path.join(tmpdir, "concat.txt")
+        with open(list_file, "w") as fd:
+            for seg in segs:
+                fd.write("file '{}'\n".format(
+                        seg["output_file"].replace("'", "'\\''")))
+        cmd = ("ffmpeg -v error -y -f concat -safe 0 "
+               f"-i {shlex.quote(list_file)} -c copy "
+               f"{shlex.quote(job['output_file'])}")
+        print("===>", cmd)
+        p = Process(shlex.split(cmd), stdin=DEVNULL, stdout=DEVNULL,
+                  stderr=PIPE, universal_newlines=True)
+        err = p.communicate()[1]
+        if p.returncode != 0:
+            print(f"ERROR: concat failed. {err.strip()}")
+            return False
+        return True
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def do_smart_cut(input_file):
+    """
+    trim the input_file re-encoding only the partial GOPs at both ends.
+    the GOPs between them are copied.
+    """
+    job = make_job(input_file)
+    if job is None:
+        return
+    codec = job["ffinfo"].get("codec_name")
+    # the pieces re-encoded keep the size, the bitrate and the profile of
+    # the source.  the whole range is converted if any of them changes.
+    if (opt.copy_codec or job["vf"] or not opt.copy_bitrate or
+        opt.profile_level is not None or opt.estimate or
+        codec not in _SMART_CUT_CODECS):
+        print("NOTE: smart cut is used only for H.264 and HEVC not to be "
+              "scaled, without -c, -R, --level, --rotate nor --estimate.")
+        convert(job)
+        return
+    if (os.path.exists(job["output_file"]) and not opt.overwrite and
+        not (manifest is not None and
+             manifest.is_partial(input_file, job["output_file"]))):
+        print("ERROR: output filename has exsted.")
+        return
+    time_start = job["time_start"]
+    keys = get_key_frames(input_file, time_start,
+                          time_start + job["total_dur"],
+                          start_time=get_start_time(job["ffinfo"]))
+    if len(keys) < 2:
+        print("NOTE: no GOP to be copied in the range.")
+        convert(job)
+        return
+    if manifest is not None:
+        manifest.start(input_file, job["output_file"], get_options())
+    result = convert_smart_cut(job, keys)
+    if manifest is not None:
+        manifest.finish(input_file, result)
+
+def convert_smart_cut(job, keys):
+    """
+    return True if it succeeded.
+    keys: the times of the key frames in the range, at least two.
+    the pieces are in MPEG-TS with the parameter sets in band so that
+    the decoder follows the change of them at the joints.
+    """
+    input_file = job["input_file"]
+    ffinfo = job["ffinfo"]
+    time_start = job["time_start"]
+    time_end = time_start + job["total_dur"]
+    k1, k2 = keys[0], keys[-1]
+    encoder, bsf = _SMART_CUT_CODECS[ffinfo["codec_name"]]
+    enc_opts = [f"-c:v {encoder}", f"-b:v {int(ffinfo['bit_rate'])}"]
+    if ffinfo.get("pix_fmt"):
+        enc_opts.append(f"-pix_fmt {ffinfo['pix_fmt']}")
+    if encoder == "libx264":
+        if ffinfo.get("profile") in _X264_PROFILES:
+            enc_opts.append(
+                    f"-profile:v {_X264_PROFILES[ffinfo['profile']]}")
+        if ffinfo.get("level", 0) > 0:
+            enc_opts.append(f"-level:v {ffinfo['level']}")
+    enc_opts = " ".join(enc_opts)
+    print("## smart cut: encode {:.3f} sec, copy {:.3f} sec, "
+          "encode {:.3f} sec".format(k1 - time_start, k2 - k1, time_end - k2))
+    tmpdir = mkdtemp(prefix=".ffcanon-",
+                     dir=os.path.dirname(os.path.abspath(job["output_file"])))
+    try:
+        pieces = []
+        for a,b,opts in [(time_start, k1, enc_opts),
+                         (k1, k2, f"-c:v copy -bsf:v {bsf}"),
+                         (k2, time_end, enc_opts)]:
+            if b - a <= 0:
+                continue
+            pieces.append({
+                    "input_file": input_file,
+                    "output_file": os.path.join(tmpdir,
+                                                f"piece{len(pieces)}.ts"),
+                    "input_opts": f"-ss {a}",
+                    "opts": f"-y -an -t {b-a} {opts}",
+                    "total_dur": b - a,
+                    "segment": True,
+                    })
+        for piece in pieces:
+            print("===>", job_command(piece))
+        with ThreadPoolExecutor(max_workers=len(pieces)) as executor:
+            results = list(executor.map(run_job, pieces))
+        for piece,result in zip(pieces, results):
+            if not result:
+                print(f"ERROR: {piece['output_file']}: {piece['error']}")
+                return False
+        # join the pieces, and put the audio of the range.
+        list_file = os.path.join(tmpdir, "concat.txt")
+        with open(list_file, "w") as fd:
+            for piece in pieces:
+                fd.write("file '{}'\n".format(
+                        piece["output_file"].replace("'", "'\\''")))
+        cmd = ("ffmpeg -v error -y -f concat -safe 0 "
+               f"-i {shlex.quote(list_file)} ")
+        if opt.no_audio:
+            cmd += "-map 0:v "
         else:
-            r = re.search(r"time=(\d+:\d+:\d+\.\d+) .*", buf)
-            if r:
-                progress_bar(parse_time(r.group(1)), total_dur)
+            cmd += (f"-ss {time_start} -t {job['total_dur']} "
+                    f"-i {shlex.quote(input_file)} -map 0:v -map 1:a? ")
+        cmd += f"-c copy {shlex.quote(job['output_file'])}"
+        print("===>", cmd)
+        p = Process(shlex.split(cmd), stdin=DEVNULL, stdout=DEVNULL,
+                    stderr=PIPE, universal_newlines=True)
+        err = p.communicate()[1]
+        if p.returncode != 0:
+            print(f"ERROR: concat failed. {err.strip()}")
+            return False
+        return True
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
-    p.wait()
+def do_batch(input_files, nb_jobs):
+    """
+    convert the files with nb_jobs ffmpeg processes at once.
+    the number of threads of each ffmpeg is set so that the total
+    matches the number of cores.
+    """
+    jobs = []
+    for f in input_files:
+        try:
+            job = make_job(f)
+        except Exception as e:
+            print(f"ERROR: {f}: {e}")
+            jobs.append({"input_file": f, "error": e})
+            continue
+        if job is not None:
+            jobs.append(job)
+    todo = [ job for job in jobs if "error" not in job ]
+    if not todo:
+        return
+    nb_threads = max(1, (os.cpu_count() or 1) // nb_jobs)
+    for job in todo:
+        print("===>", job_command(job, nb_threads=nb_threads))
+    mp = MultiProgress()
+    def run(job):
+        name = os.path.basename(job["input_file"])
+        mp.update(name, 0, job["total_dur"])
+        t0 = time.monotonic()
+        try:
+            result = run_job(job, nb_threads=nb_threads,
+                             progress=lambda job, info: mp.update(
+                                    name, info["time"] or 0, job["total_dur"],
+                                    progress_eta(info, job["total_dur"])))
+        except Exception as e:
+            result = False
+            job["error"] = e
+        job["elapsed"] = time.monotonic() - t0
+        mp.done(name, "done" if result else "FAILED")
+        return result
+    #
+    print(f"## {len(todo)} jobs, {nb_jobs} at once, {nb_threads} threads each.")
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+        results = list(executor.map(run, todo))
+    wall_time = time.monotonic() - t0
+    # summary
+    media_time = sum([ job["total_dur"] for job,result in zip(todo, results)
+                      if result ])
+    failures = [ job for job,result in zip(todo, results) if not result ]
+    failures.extend([ job for job in jobs if job not in todo ])
+    print("## summary")
+    print("wall time :", str(timedelta(seconds=round(wall_time))))
+    print("media time:", str(timedelta(seconds=round(media_time))))
+    if wall_time > 0:
+        print("realtime  : x{:.2f}".format(media_time/wall_time))
+    print("succeeded :", results.count(True))
+    print("failed    :", len(failures))
+    for job in failures:
+        print("  ", job["input_file"], job.get("error", ""))
+
+def move_into(path, dir_name):
+    """
+    move the file into the directory, renaming it if the name is used.
+    """
+    os.makedirs(dir_name, exist_ok=True)
+    bname, ext = os.path.splitext(os.path.basename(path))
+    dst = os.path.join(dir_name, bname + ext)
+    i = 0
+    while os.path.exists(dst):
+        i += 1
+        dst = os.path.join(dir_name, f"{bname}-{i}{ext}")
+    shutil.move(path, dst)
+    return dst
+
+def ingest(input_file, nb_threads):
+    """
+    convert a file found by do_watch(), then move it into the done folder,
+    or the failed folder.  a file not needed to convert is done.
+    """
+    watch_dir = os.path.dirname(input_file)
+    done_dir = opt.done_dir or os.path.join(watch_dir, "done")
+    failed_dir = opt.failed_dir or os.path.join(watch_dir, "failed")
+    t0 = time.monotonic()
+    try:
+        job = make_job(input_file)
+        if job is None:
+            result = True
+        else:
+            print("===>", job_command(job, nb_threads=nb_threads))
+            existed = os.path.exists(job["output_file"])
+            result = run_job(job, nb_threads=nb_threads)
+            if not result:
+                print(f"ERROR: {input_file}: {job['error']}")
+                # remove only the output this job created.
+                if not existed and os.path.exists(job["output_file"]):
+                    os.remove(job["output_file"])
+    except Exception as e:
+        print(f"ERROR: {input_file}: {e}")
+        result = False
+    dst = move_into(input_file, done_dir if result else failed_dir)
+    print("## {}: {} in {}".format("done" if result else "FAILED", dst,
+            str(timedelta(seconds=round(time.monotonic() - t0)))))
+    return result
+
+def do_watch(dirs, nb_jobs):
+    """
+    convert the files put into the dirs.  a file is picked up when its
+    size and mtime have not changed for opt.settle_time seconds.
+    the files in the dirs at the start are also converted.
+    """
+    watcher = Watcher(dirs, poll_interval=opt.poll_interval,
+                      use_inotify=not opt.use_polling)
+    prefixes = [ f".{x}" for x in opt.prefixes.split(",") ]
+    def is_candidate(path):
+        name = os.path.basename(path)
+        return (not name.startswith(".") and
+                not name.endswith("-dst.mp4") and
+                os.path.splitext(name)[1].lower() in prefixes)
+    nb_threads = max(1, (os.cpu_count() or 1) // nb_jobs)
+    # path: ((size, mtime), the time when it was seen first in the state)
+    pending = dict([ (path, None) for path in watcher.list_files()
+                     if is_candidate(path) ])
+    running = {}
+    print(f"## watching {', '.join(watcher.dirs)} by {watcher.mode}, "
+          f"{nb_jobs} jobs at once.")
+    executor = ThreadPoolExecutor(max_workers=nb_jobs)
+    try:
+        while True:
+            timeout = 1 if pending else 60
+            for path in watcher.wait(timeout):
+                if is_candidate(path) and path not in running:
+                    pending[path] = None
+            now = time.monotonic()
+            for path,state in list(pending.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # it's gone.
+                    del pending[path]
+                    continue
+                sig = (st.st_size, st.st_mtime_ns)
+                if state is None or state[0] != sig:
+                    pending[path] = (sig, now)
+                elif now - state[1] >= opt.settle_time:
+                    del pending[path]
+                    running[path] = executor.submit(ingest, path, nb_threads)
+            for path in [ p for p,f in running.items() if f.done() ]:
+                del running[path]
+    except KeyboardInterrupt:
+        print("## stopped.")
+    finally:
+        executor.shutdown(wait=True)
+        watcher.close()
 
 #
 #
@@ -134,6 +784,8 @@ ap = argparse.ArgumentParser(
 ap.add_argument("input_file", nargs="+", help="a movie file.")
 ap.add_argument("-o", "--output", action="store", dest="output_file",
                 help="specify the filename converted.")
+ap.add_argument("--output-dir", action="store", dest="output_dir",
+                help="specify the directory to put the files converted.")
 ap.add_argument("-c", "--copy", action="store_true", dest="copy_codec",
                 help="specify to copy codec.")
 ap.add_argument("--level", action="store", dest="profile_level",
@@ -146,13 +798,77 @@ ap.add_argument("--rotate", action="store", dest="rotate",
                 help="specify the direction of 90 rotation.")
 ap.add_argument("-st", "--time-start", "--start-time",
                 action="store", dest="time_start",
-                help="pass the value to ffmpeg the -ss option.")
+                help="specify the start time, seeking the input.")
 ap.add_argument("-et", "--time-end", "--end-time",
                 action="store", dest="time_end",
-                help="pass the value to ffmpeg the -to option.")
+                help="specify the end time.")
 ap.add_argument("-dt", "--time-duration",
                 action="store", dest="time_duration",
-                help="pass the value to ffmpeg the -t option.")
+                help="specify the duration from the start time.")
+ap.add_argument("--output-seek", action="store_true", dest="output_seek",
+                help="pass -ss to ffmpeg as an output option as before.  "
+                "by default, it is an input option to seek the input "
+                "instead of decoding the frames before the start.")
+ap.add_argument("--smart-cut", action="store_true", dest="smart_cut",
+                help="re-encode only the partial GOPs at the start and "
+                "the end of the range, and copy the others.  the range is "
+                "converted as usual if the video is scaled, or with -c, "
+                "-R, --level, --rotate or --estimate.")
+ap.add_argument("-j", action="store", dest="nb_jobs",
+                type=int, default=1,
+                help="specify the number of files converted at once.")
+ap.add_argument("--segments", action="store", dest="nb_segments",
+                type=int, default=1,
+                help="specify the number of segments of a file converted "
+                "in parallel.  the file is split at key frames.")
+ap.add_argument("--estimate", action="store_true", dest="estimate",
+                help="encode the samples with the candidates, and use "
+                "the one with the lowest bitrate meeting --target-ssim.")
+ap.add_argument("--candidates", action="store", dest="candidates",
+                default="18,20,23,26,28",
+                help="specify the candidates for --estimate separated by "
+                "comma.  a number is a CRF, and one followed by k or M "
+                "is a bitrate, e.g. 1M,2M,4M.")
+ap.add_argument("--target-ssim", action="store", dest="target_ssim",
+                type=float, default=0.98,
+                help="specify the minimum SSIM of the samples.")
+ap.add_argument("--samples", action="store", dest="nb_samples",
+                type=int, default=4,
+                help="specify the number of the samples for --estimate.")
+ap.add_argument("--sample-duration", action="store", dest="sample_duration",
+                type=float, default=10,
+                help="specify the duration in seconds of each sample.")
+ap.add_argument("--watch", action="store_true", dest="watch",
+                help="watch the directories specified instead of files, "
+                "and convert the files put into them.")
+ap.add_argument("--done-dir", action="store", dest="done_dir",
+                help="specify the directory to move the files converted "
+                "or not needed to convert with --watch.  "
+                "it is done/ in the directory watched by default.")
+ap.add_argument("--failed-dir", action="store", dest="failed_dir",
+                help="specify the directory to move the files failed "
+                "with --watch.  it is failed/ in the directory watched "
+                "by default.")
+ap.add_argument("--settle", action="store", dest="settle_time",
+                type=float, default=5,
+                help="specify the seconds for which the size and mtime of "
+                "a file must not change before it is converted.")
+ap.add_argument("--poll", action="store_true", dest="use_polling",
+                help="poll the directories instead of inotify.")
+ap.add_argument("--poll-interval", action="store", dest="poll_interval",
+                type=float, default=2,
+                help="specify the interval of the polling in seconds.")
+ap.add_argument("--prefixes", action="store", dest="prefixes",
+                default="mp4,mkv,avi,flv,vob,wmv,mov,mpg,m4v,webm",
+                help="specify prefixes of the files converted with --watch, "
+                "comma separated.")
+ap.add_argument("--telemetry", action="store", dest="telemetry_file",
+                help="specify a file to append the progress of ffmpeg "
+                "in NDJSON.")
+ap.add_argument("--manifest", action="store", dest="manifest_file",
+                help="specify a file to record the conversions.  "
+                "the files converted with the same options are skipped, "
+                "and the partial outputs are converted again.")
 ap.add_argument("-an", action="store_true", dest="no_audio",
                 help="remove audio..")
 ap.add_argument("-f", action="store_true", dest="force",
@@ -164,9 +880,20 @@ ap.add_argument("-y", action="store_true", dest="overwrite",
                 help="overwrite the output file.")
 ap.add_argument("-p", action="store_true", dest="show_profile",
                 help="show only profile.")
+add_probe_arguments(ap)
 ap.add_argument("-v", action="store_true", dest="verbose",
                 help="verbose mode.")
 opt = ap.parse_args()
+# the run modes are not combined.  -j is used by --watch too.
+modes = [ name for name,used in [("--watch", opt.watch),
+                                 ("--smart-cut", opt.smart_cut),
+                                 ("--segments", opt.nb_segments > 1)]
+         if used ]
+if len(modes) > 1:
+    ap.error("{} can't be used together.".format(" and ".join(modes)))
+if opt.nb_jobs > 1 and (opt.smart_cut or opt.nb_segments > 1):
+    ap.error("-j can't be used with {}.".format(modes[0]))
+setup_probe(opt)
 
 # force ?
 if set([opt.rotate, opt.scale, opt.time_start, opt.time_end, opt.time_duration,
@@ -174,11 +901,30 @@ if set([opt.rotate, opt.scale, opt.time_start, opt.time_end, opt.time_duration,
     opt.force = True
     print("NOTE: set opt.force.")
 
+manifest = None
+if opt.manifest_file:
+    manifest = Manifest(opt.manifest_file)
+
+telemetry = None
+if opt.telemetry_file:
+    telemetry = Telemetry(opt.telemetry_file)
+
 ##
 if opt.input_file == ["-"]:
-    for f in sys.stdin:
-        do_main(f.strip())
+    input_files = ( f.strip() for f in sys.stdin )
+else:
+    input_files = ( f.strip() for f in opt.input_file )
+if opt.watch:
+    do_watch(list(input_files), opt.nb_jobs)
+elif opt.smart_cut:
+    for f in input_files:
+        do_smart_cut(f)
+elif opt.nb_segments > 1:
+    for f in input_files:
+        do_segmented(f, opt.nb_segments)
+elif opt.nb_jobs > 1:
+    do_batch(list(input_files), opt.nb_jobs)
 else:
-    for f in opt.input_file:
-        do_main(f.strip())
+    for f in input_files:
+        do_main(f)
 
@@ -0,0 +1,243 @@
+import os
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from fftools import CACHE_DIR, get_stream_info
+
+# columns which can be used in the filters of Catalog.query().
+FILTER_COLUMNS = ["bit_rate", "width", "height", "fps", "duration",
+                  "profile", "ext"]
+
+class Catalog():
+
+    def __init__(self, db_file=None, verbose=False):
+        """
+        persistent catalog of the probe results of video files.
+        the mtime of each directory is recorded so that a rescan descends
+        only into the directories changed.  note that a file overwritten
+        in place doesn't change the mtime of its directory.  use
+        scan(full=True) to check all files.
+        the extensions scanned are recorded too so that a directory is
+        rescanned when other extensions are asked.
+        """
+        if db_file is None:
+            db_file = os.path.join(CACHE_DIR, "catalog.sqlite3")
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self.verbose = verbose
+        self.db = sqlite3.connect(db_file)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT,
+                prefixes TEXT);
+                CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, dir TEXT, ext TEXT,
+                size INTEGER, mtime_ns INTEGER, ino INTEGER,
+                bit_rate REAL, width INTEGER, height INTEGER, fps REAL,
+                duration REAL, profile TEXT, info TEXT, error TEXT);
+                CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+                CREATE INDEX IF NOT EXISTS files_bit_rate ON files (bit_rate);
+                CREATE INDEX IF NOT EXISTS files_width ON files (width);
+                CREATE INDEX IF NOT EXISTS files_height ON files (height);
+                CREATE INDEX IF NOT EXISTS files_fps ON files (fps);
+                CREATE INDEX IF NOT EXISTS files_duration ON files (duration);
+                CREATE INDEX IF NOT EXISTS files_profile ON files (profile);
+                CREATE INDEX IF NOT EXISTS files_ext ON files (ext);
+                """)
+        # the catalog made before the prefixes were recorded.
+        if "prefixes" not in [ r[1] for r in self.db.execute(
+                "PRAGMA table_info(dirs)") ]:
+            self.db.execute("ALTER TABLE dirs ADD COLUMN prefixes TEXT")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def scan(self, path, recursive=False, prefixes=None, nb_jobs=1,
+             full=False):
+        """
+        update the catalog under the path.
+        return a list of (path, error) of the files not probed.
+        prefixes: a list of extensions to be cataloged, e.g. [".mp4"].
+        full: check all files even if the directory is not changed.
+        """
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            if not full and self._is_unchanged(path):
+                return []
+            errors = self._update_files([path], nb_jobs)
+            self.db.commit()
+            return errors
+        todo = []
+        self._scan_dir(path, recursive, prefixes, full, todo)
+        errors = self._update_files(todo, nb_jobs)
+        self.db.commit()
+        return errors
+
+    def _is_unchanged(self, path):
+        """
+        return True if the file is cataloged with its size, mtime and inode.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        row = self.db.execute("SELECT size, mtime_ns, ino FROM files "
+                              "WHERE path = ?", (path,)).fetchone()
+        return row == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def _scan_dir(self, path, recursive, prefixes, full, todo):
+        """
+        append the files to be probed into todo.
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            self._remove_dir(path)
+            return
+        row = self.db.execute("SELECT mtime_ns, subdirs, prefixes "
+                              "FROM dirs WHERE path = ?", (path,)).fetchone()
+        # the extensions scanned before, None means all.  the directory
+        # is scanned with them too so that their files are kept.
+        if row is None or row[2] is None:
+            covered = False
+            scan_prefixes = prefixes
+        else:
+            scanned = json.loads(row[2])
+            if scanned is None:
+                covered = True
+                scan_prefixes = None
+            elif prefixes is None:
+                covered = False
+                scan_prefixes = None
+            else:
+                covered = set(prefixes) <= set(scanned)
+                scan_prefixes = sorted(set(prefixes) | set(scanned))
+        if (row is not None and row[0] == mtime_ns and covered and
+            not full):
+            if self.verbose:
+                print(f"UNCHANGED: {path}")
+            if recursive:
+                for sub in json.loads(row[1]):
+                    self._scan_dir(sub, recursive, prefixes, full, todo)
+            return
+        if self.verbose:
+            print(f"SCAN: {path}")
+        subdirs = []
+        files = {}
+        with os.scandir(path) as fd:
+            for entry in fd:
+                if entry.name.startswith(".."):
+                    continue
+                elif entry.is_dir():
+                    subdirs.append(entry.path)
+                else:
+                    ext = os.path.splitext(entry.name)[1]
+                    if scan_prefixes is None or ext in scan_prefixes:
+                        files[entry.path] = entry.stat()
+        # remove the entries gone.
+        known = dict([ (r[0], r[1:]) for r in self.db.execute(
+                "SELECT path, size, mtime_ns, ino FROM files WHERE dir = ?",
+                (path,)) ])
+        for f in known:
+            if f not in files:
+                self.db.execute("DELETE FROM files WHERE path = ?", (f,))
+        if row is not None:
+            for sub in json.loads(row[1]):
+                if sub not in subdirs:
+                    self._remove_dir(sub)
+        # the files added or changed.
+        for f,st in files.items():
+            if known.get(f) != (st.st_size, st.st_mtime_ns, st.st_ino):
+                todo.append(f)
+        self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?,?,?,?)",
+                        (path, mtime_ns, json.dumps(subdirs),
+                         json.dumps(scan_prefixes)))
+        if recursive:
+            for sub in subdirs:
+                self._scan_dir(sub, recursive, prefixes, full, todo)
+
+    def _remove_dir(self, path):
+        prefix_range = (path + "/", path + "0")
+        self.db.execute("DELETE FROM dirs WHERE path = ? OR "
+                        "(path >= ? AND path < ?)", (path, *prefix_range))
+        self.db.execute("DELETE FROM files WHERE path >= ? AND path < ?",
+                        prefix_range)
+
+    def _update_files(self, paths, nb_jobs):
+        def probe(path):
+            try:
+                return get_stream_info(path, codec_type="video",
+                                       verbose=self.verbose)[0], None
+            except Exception as e:
+                return None, e
+        errors = []
+        with ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+            for path,(ffinfo,e) in zip(paths, executor.map(probe, paths)):
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    errors.append((path, e))
+                    continue
+                row = [path, os.path.dirname(path),
+                       os.path.splitext(path)[1],
+                       st.st_size, st.st_mtime_ns, st.st_ino]
+                if ffinfo is None:
+                    errors.append((path, e))
+                    row.extend([None]*7 + [str(e)])
+                else:
+                    row.extend([ffinfo.get("bit_rate"),
+                                ffinfo.get("coded_width"),
+                                ffinfo.get("coded_height"),
+                                ffinfo.get("fps"),
+                                ffinfo.get("duration"),
+                                ffinfo.get("profile"),
+                                json.dumps(ffinfo), None])
+                self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                                "(?,?,?,?,?,?,?,?,?,?,?,?,?,?)", row)
+        return errors
+
+    def query(self, paths=None, recursive=True, order="path", **filters):
+        """
+        yield ffinfo of the files matched with the filters.
+        paths: a list of files or directories to be searched.
+        recursive: include the files in the subdirectories of the paths.
+        filters: "min_" or "max_" followed by a column in FILTER_COLUMNS,
+            or a column in FILTER_COLUMNS for the exact match.
+            a list is for any of the values.  None is ignored.
+            a file of which value is unknown is not filtered by the range
+            as ffls.py does without the catalog.
+        """
+        where = ["info IS NOT NULL"]
+        args = []
+        for k,v in filters.items():
+            if v is None:
+                continue
+            if k.startswith("min_") and k[4:] in FILTER_COLUMNS:
+                where.append(f"({k[4:]} IS NULL OR {k[4:]} >= ?)")
+                args.append(v)
+            elif k.startswith("max_") and k[4:] in FILTER_COLUMNS:
+                where.append(f"({k[4:]} IS NULL OR {k[4:]} <= ?)")
+                args.append(v)
+            elif k in FILTER_COLUMNS:
+                if not isinstance(v, (list, tuple)):
+                    v = [v]
+                where.append("{} IN ({})".format(k, ",".join("?"*len(v))))
+                args.extend(v)
+            else:
+                raise ValueError(f"ERROR: unknown filter {k}")
+        if paths:
+            cond = []
+            for path in paths:
+                path = os.path.abspath(path)
+                if recursive:
+                    cond.append("path = ? OR (path >= ? AND path < ?)")
+                    args.extend([path, path + "/", path + "0"])
+                else:
+                    cond.append("path = ? OR dir = ?")
+                    args.extend([path, path])
+            where.append("({})".format(" OR ".join(cond)))
+        sql = "SELECT info FROM files WHERE {} ORDER BY {}".format(
+                " AND ".join(where), order)
+        for row in self.db.execute(sql, args):
+            yield json.loads(row[0])
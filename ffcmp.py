@@ -2,32 +2,60 @@
 
 import sys
 import json
-from fftools import get_stream_info
+import math
+from datetime import timedelta
+from fftools import (get_stream_info, add_probe_arguments, setup_probe,
+                     measure_quality)
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# the keys of the signature to group the files.
+SIGNATURE_KEYS = ["codec_name", "profile", "level", "coded_width",
+                  "coded_height", "fps", "pix_fmt", "field_order",
+                  "display_aspect_ratio", "color_space"]
 
 # get common keys.
 def get_common_keys(dict_list, shallow=True, ignore_keys=None):
     """
     it keeps keys order as much as possible.
     the fist one in dict_list is used as a base.
+    a new key found in another dict is placed after the key preceding it
+    in the dict.  the keys are kept in a linked list so that it runs in
+    linear time.
     """
-    if len(dict_list) == 0:
-        return []
-    keys = []
+    ignore_keys = set(ignore_keys or [])
+    next_key = {}
+    head = None
     for dct in dict_list:
-        for i,kv in enumerate(dct.items()):
-            if isinstance(kv[1], (dict, list)):
-                continue
-            if kv[0] in ignore_keys:
+        prev = None
+        for k,v in dct.items():
+            if isinstance(v, (dict, list)):
                 continue
-            if kv[0] in keys:
+            if k in ignore_keys:
                 continue
-            keys.insert(i,kv[0])
+            if k not in next_key:
+                if prev is None:
+                    next_key[k] = head
+                    head = k
+                else:
+                    next_key[k] = next_key[prev]
+                    next_key[prev] = k
+            prev = k
+    keys = []
+    k = head
+    while k is not None:
+        keys.append(k)
+        k = next_key[k]
     return keys
 
-def show_dicts(*dicts, ignore_keys=None, only_diffs=False, target=None):
+def show_dicts(*dicts, ignore_keys=None, only_diffs=False, target=None,
+               labels=None, prefix="#V"):
     """
     dicts: a list of dicts
+    only_diffs: show only the keys of which values are different.
+    labels: a list of the names of the dicts shown in the footer.
+        the "path" of each dict is used by default.
+    prefix: the prefix of the column names.
     """
     if target is not None:
         if not isinstance(target, list):
@@ -35,15 +63,21 @@ def show_dicts(*dicts, ignore_keys=None, only_diffs=False, target=None):
         # reconstruct the dicts.
         dicts = [ dicts[i] for i in target ]
     keys = get_common_keys(dicts, ignore_keys=ignore_keys)
-    max_key_len = max([len(k) for k in keys])
+    if only_diffs:
+        keys = [ k for k in keys if is_different(k, dicts) ]
+        if not keys:
+            print("NOTE: no difference.")
+            return
+    max_key_len = max([len(k) for k in keys] + [len("Key Name")])
     max_val_len = []
     for dct in dicts:
         max_val_len.append(max([len(str(v))
                                 for k,v in dct.items()
-                                if k in keys ]))
+                                if k in keys ], default=0))
     # table header
+    max_val_len = [ max(n, len(prefix)+2) for n in max_val_len ]
     print("{} D {}".format("Key Name".ljust(max_key_len),
-                           " ".join(["#V{:02}".format(i).ljust(max_val_len[i])
+                           " ".join([f"{prefix}{i:02}".ljust(max_val_len[i])
                                      for i,dct in enumerate(dicts)])))
     print("{} = {}".format("="*max_key_len,
                            " ".join(["="*max_val_len[i]
@@ -52,20 +86,7 @@ def show_dicts(*dicts, ignore_keys=None, only_diffs=False, target=None):
     for k in keys:
         line = [ f"{k.ljust(max_key_len)}" ]
         # adding Diff Flag.
-        for dct in dicts:
-            if k not in dct:
-                # the key doesn't exist, but does in any other dict.
-                line.append("X")
-                break
-        else:
-            # now the key exists in all the dicts.
-            for dct in dicts[1:]:
-                if dicts[0][k] != dct[k]:
-                    line.append("X")
-                    break
-            else:
-                # all the values are same.
-                line.append(" ")
+        line.append("X" if is_different(k, dicts) else " ")
         #
         for i,dct in enumerate(dicts):
             if k in dct:
@@ -79,7 +100,150 @@ def show_dicts(*dicts, ignore_keys=None, only_diffs=False, target=None):
                            " ".join(["="*max_val_len[i]
                                      for i,dct in enumerate(dicts)])))
     for i,dct in enumerate(dicts):
-        print("#V{:02}:{}".format(i,dct["filename"]))
+        if labels is not None:
+            label = labels[i]
+        else:
+            label = dct.get("path")
+        print(f"{prefix}{i:02}:{label}")
+
+def is_different(k, dicts):
+    for dct in dicts:
+        if k not in dct:
+            # the key doesn't exist, but does in any other dict.
+            return True
+    # now the key exists in all the dicts.
+    for dct in dicts[1:]:
+        if dicts[0][k] != dct[k]:
+            return True
+    # all the values are same.
+    return False
+
+def probe_all(input_files, nb_jobs):
+    """
+    return a list of ffinfo of the input_files probed concurrently,
+    and a list of (path, error) of the files failed.
+    """
+    def probe(f):
+        try:
+            return get_stream_info(f, codec_type="video",
+                                   verbose=opt.verbose)[0], None
+        except Exception as e:
+            return None, e
+    infos = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+        for f,(ffinfo,e) in zip(input_files, executor.map(probe, input_files)):
+            if ffinfo is None:
+                errors.append((f, e))
+            else:
+                infos.append(ffinfo)
+    return infos, errors
+
+def show_clusters(infos, sig_keys):
+    """
+    group the files by the values of sig_keys, and show the clusters
+    in order of the number of members with the keys differing.
+    """
+    clusters = {}
+    for ffinfo in infos:
+        sig = tuple([ str(ffinfo.get(k)) for k in sig_keys ])
+        clusters.setdefault(sig, []).append(ffinfo["path"])
+    clusters = sorted(clusters.items(), key=lambda x: -len(x[1]))
+    sigs = []
+    for sig,members in clusters:
+        d = { k:v for k,v in zip(sig_keys, sig) }
+        d["members"] = len(members)
+        sigs.append(d)
+    print(f"## {len(infos)} files in {len(clusters)} clusters.")
+    if len(clusters) > 1:
+        show_dicts(*sigs, only_diffs=True, prefix="#C",
+                   labels=[ f"{len(m)} files" for s,m in clusters ])
+    for i,(sig,members) in enumerate(clusters):
+        print(f"## #C{i:02}: {len(members)} files")
+        for path in members:
+            print(path)
+
+def get_nb_frames(ffinfo, duration):
+    try:
+        return int(ffinfo["nb_frames"])
+    except (KeyError, ValueError):
+        return round(duration*ffinfo["fps"])
+
+def verify_quality(src_file, dst_file):
+    """
+    compare dst_file converted from src_file in the windows evenly spaced,
+    in parallel.  the source is rotated and scaled as the output.
+    return False if the SSIM of any window is less than opt.min_ssim.
+    """
+    src = get_stream_info(src_file, codec_type="video",
+                          verbose=opt.verbose)[0]
+    dst = get_stream_info(dst_file, codec_type="video",
+                          verbose=opt.verbose)[0]
+    expected_dur = src["duration"] - opt.offset
+    duration = min(dst["duration"], expected_dur)
+    win_dur = opt.window_duration
+    if opt.nb_windows*win_dur >= duration:
+        starts = [0]
+        win_dur = duration
+    else:
+        step = duration / opt.nb_windows
+        starts = [ max(0, step*(i+0.5) - win_dur/2)
+                   for i in range(opt.nb_windows) ]
+    def measure(t, vf):
+        return measure_quality(dst_file, src_file,
+                               input_opts=f"-ss {t} -t {win_dur}",
+                               reference_opts=(f"-ss {t+opt.offset} "
+                                               f"-t {win_dur}"),
+                               reference_vf=vf, verbose=opt.verbose)
+    scale = "scale={}:{}".format(dst["width"], dst["height"])
+    if opt.rotate is not None:
+        vf = "transpose={},{}".format(
+                1 if opt.rotate in ["r", "right"] else 2, scale)
+    elif (src["width"] > src["height"]) != (dst["width"] > dst["height"]):
+        # rotated, but the direction is not known.
+        candidates = [ f"transpose={i},{scale}" for i in [1,2] ]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            qs = list(executor.map(lambda vf: measure(starts[0], vf),
+                                   candidates))
+        vf = max(zip(candidates, qs), key=lambda x: x[1].get("ssim", 0))[0]
+        print(f"NOTE: the rotation is guessed, {vf.split(',')[0]}.")
+    else:
+        vf = scale
+    print("## {} against {}, {} windows of {:.1f} sec, filters: {}".format(
+            dst_file, src_file, len(starts), win_dur, vf))
+    with ThreadPoolExecutor(max_workers=opt.nb_jobs) as executor:
+        results = list(executor.map(lambda t: measure(t, vf), starts))
+    print("Start            SSIM     PSNR")
+    for t,q in zip(starts, results):
+        print("{:14}  {:7.5f} {:8.3f}".format(
+                str(timedelta(seconds=round(t, 3)))[:14],
+                q.get("ssim", math.nan), q.get("psnr", math.nan)))
+    ssim = [ q["ssim"] for q in results if "ssim" in q ]
+    psnr = [ q["psnr"] for q in results if "psnr" in q ]
+    print("## aggregate")
+    if ssim:
+        print("avr SSIM :", round(sum(ssim)/len(ssim), 5))
+        print("min SSIM :", round(min(ssim), 5))
+    if psnr:
+        print("avr PSNR :", round(sum(psnr)/len(psnr), 3))
+        print("min PSNR :", round(min(psnr), 3))
+    print("## drift")
+    print("duration : src {:.3f} dst {:.3f} diff {:+.3f}".format(
+            expected_dur, dst["duration"], dst["duration"] - expected_dur))
+    if opt.offset:
+        src_frames = round(expected_dur*src["fps"])
+    else:
+        src_frames = get_nb_frames(src, expected_dur)
+    dst_frames = get_nb_frames(dst, dst["duration"])
+    print("frames   : src {} dst {} diff {:+}".format(
+            src_frames, dst_frames, dst_frames - src_frames))
+    if src["fps"] != dst["fps"]:
+        print("NOTE: fps is changed from {} to {}.".format(src["fps"],
+                                                       dst["fps"]))
+    if ssim and min(ssim) < opt.min_ssim:
+        print(f"ERROR: SSIM is less than {opt.min_ssim}.")
+        return False
+    return True
 
 ap = argparse.ArgumentParser(
         description="compare the parameters of video files.",
@@ -88,19 +252,76 @@ ap.add_argument("input_file", nargs="+", help="movie file.")
 ap.add_argument("-t", action="store", dest="_target",
                 help="specify the target to be compared, "
                 "0 origin, comma separated.")
+add_probe_arguments(ap)
+ap.add_argument("-d", action="store_true", dest="only_diffs",
+                help="show only the keys of which values are different.")
+ap.add_argument("-g", action="store_true", dest="show_clusters",
+                help="group the files by the signature of the parameters.")
+ap.add_argument("--keys", action="store", dest="sig_keys",
+                default=",".join(SIGNATURE_KEYS),
+                help="specify the keys of the signature, comma separated.")
+ap.add_argument("-j", action="store", dest="nb_jobs",
+                type=int, default=8,
+                help="specify the number of files probed, or the windows "
+                "compared with -Q, in parallel.")
+ap.add_argument("-Q", action="store_true", dest="verify",
+                help="compare the quality of the second file converted "
+                "from the first one in the sampled windows.")
+ap.add_argument("--windows", action="store", dest="nb_windows",
+                type=int, default=5,
+                help="specify the number of the windows with -Q.")
+ap.add_argument("--window-duration", action="store", dest="window_duration",
+                type=float, default=5,
+                help="specify the duration in seconds of each window.")
+ap.add_argument("--offset", action="store", dest="offset",
+                type=float, default=0,
+                help="specify the time in the source of the start of "
+                "the output, e.g. -st of ffcanon.py.")
+ap.add_argument("--rotate", action="store", dest="rotate",
+                default=None, choices=["right", "r", "left", "l"],
+                help="specify the rotation applied by ffcanon.py.  "
+                "it is guessed from the sizes by default.")
+ap.add_argument("--min-ssim", action="store", dest="min_ssim",
+                type=float, default=0.95,
+                help="specify the SSIM of a window to fail with -Q.")
 ap.add_argument("-v", action="store_true", dest="verbose",
                 help="verbose mode.")
 opt = ap.parse_args()
+setup_probe(opt)
 
-opt.target = None
+# select the files before probing so that the indices still point to
+# the files specified when any of them fails.
 if opt._target is not None:
-    opt.target = [int(i) for i in opt._target.split(",")]
+    try:
+        opt.input_file = [ opt.input_file[int(i)]
+                          for i in opt._target.split(",") ]
+    except (ValueError, IndexError):
+        print(f"ERROR: invalid target {opt._target}")
+        sys.exit(1)
 if opt.verbose:
     codec_ignore_keys = ["filename"]
 else:
     codec_ignore_keys = ["filename", "codec_long_name"]
 
-show_dicts(*[ get_stream_info(f, codec_type="video", verbose=opt.verbose)[0]
-             for f in opt.input_file ],
-           ignore_keys=codec_ignore_keys,
-           target=opt.target)
+if opt.verify:
+    if len(opt.input_file) != 2:
+        print("ERROR: -Q requires the source and the output.")
+        sys.exit(1)
+    try:
+        result = verify_quality(*opt.input_file)
+    except Exception as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    sys.exit(0 if result else 1)
+
+infos, errors = probe_all(opt.input_file, opt.nb_jobs)
+if opt.show_clusters:
+    show_clusters(infos, opt.sig_keys.split(","))
+elif infos:
+    show_dicts(*infos,
+               ignore_keys=codec_ignore_keys,
+               only_diffs=opt.only_diffs)
+for f,e in errors:
+    print(f"ERROR: {f}: {e}", file=sys.stderr)
+if errors:
+    sys.exit(1)
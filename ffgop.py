@@ -1,9 +1,275 @@
 #!/usr/bin/env python
 
 import sys
-from fftools import get_frames, get_stream_info
+import time
+import csv
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from fftools import (iter_frames, iter_packets, get_stream_info,
+                     add_probe_arguments, setup_probe, metrics)
+from ffstat import FrameTable, StreamStat
 import argparse
 
+def read_frames(read_intervals=None):
+    """
+    read the frames by decoding them.  pict_type is available.
+    """
+    frames = iter_frames(opt.input_file,
+                         entries=["key_frame", "pict_type", "pkt_pts_time",
+                                  "pkt_size"],
+                         read_intervals=read_intervals,
+                         verbose=opt.verbose)
+    try:
+        return FrameTable.from_frames(
+                frames, max_frames=0 if read_intervals else opt.max_frames)
+    finally:
+        frames.close()
+
+def read_packets(read_intervals=None):
+    """
+    read the packets without decoding.  pict_type is not available.
+    """
+    packets = iter_packets(opt.input_file,
+                           entries=["pts_time", "size", "flags"],
+                           read_intervals=read_intervals,
+                           verbose=opt.verbose)
+    try:
+        return FrameTable.from_packets(
+                packets, max_packets=0 if read_intervals else opt.max_frames)
+    finally:
+        packets.close()
+
+def read_windows(reader, duration):
+    """
+    return a list of the FrameTables read by the reader.
+    if sampling is specified, the frames are read from the windows evenly
+    spaced across the duration concurrently.  the frames of each window
+    are in an element of the list.  otherwise, the list has one element.
+    """
+    if not opt.nb_samples or opt.nb_samples*opt.sample_duration >= duration:
+        return [ reader() ]
+    step = duration / opt.nb_samples
+    intervals = []
+    for i in range(opt.nb_samples):
+        start = max(0, step*(i+0.5) - opt.sample_duration/2)
+        intervals.append(f"{start:.3f}%+{opt.sample_duration}")
+    if opt.verbose:
+        print("INTERVALS:", intervals)
+    with ThreadPoolExecutor(max_workers=opt.nb_jobs) as executor:
+        return list(executor.map(reader, intervals))
+
+def iter_patterns(frames):
+    """
+    yield the pattern of each GOP in the frames.
+    the last one, which may be truncated, is not yielded.
+    """
+    patt = []
+    for k,sym in zip(frames.key, frames.symbols()):
+        if k and patt:
+            yield "".join(patt)
+            patt = []
+        patt.append(sym)
+
+def show_pattern_stat(windows):
+    print("nb   Size Pattern")
+    print("==== ==== =======")
+    patt_stat = {}
+    for frames in windows:
+        for p in iter_patterns(frames):
+            patt_stat.setdefault(p, 0)
+            patt_stat[p] += 1
+    #
+    for k,v in patt_stat.items():
+        print("{:4} {:4} {}".format(v, len(k), k))
+
+def show_pattern(windows):
+    print("Size Pattern")
+    print("==== =======")
+    if opt.add_newline:
+        nl = "\n"
+    else:
+        nl = ""
+    #
+    for frames in windows:
+        if len(frames) == 0:
+            continue
+        if len(windows) > 1:
+            print("## from {}".format(frames.pts[0]))
+        for p in iter_patterns(frames):
+            sys.stdout.write("{:4} {}{}".format(len(p), p, nl))
+        print()
+
+def show_size_stat(windows):
+    print("nb   Size")
+    print("==== ====")
+    size_stat = {}
+    for frames in windows:
+        for nb in frames.gop_lengths():
+            size_stat.setdefault(int(nb), 0)
+            size_stat[int(nb)] += 1
+    for k,v in sorted(size_stat.items()):
+        print("{:4} {:4}".format(v, k))
+
+def show_stat(windows):
+    """
+    the GOPs are merged across the windows.  the last GOP in each window
+    is not counted because it may be truncated.
+    """
+    gop_time = []
+    gop_bytes = []
+    nb_keys = 0
+    for frames in windows:
+        gop_time.extend(frames.gop_durations())
+        gop_bytes.extend(frames.gop_bytes())
+        nb_keys += len(frames.key_index())
+        nb_x = sum([1 for k,p in zip(frames.key, frames.pict) if k and p > 1])
+        if nb_x:
+            print(f"WARNING: {nb_x} key frames, but not type I.")
+    if gop_time:
+        print("## GOP size in seconds.")
+        if len(windows) > 1:
+            print("nb of win:", len(windows))
+        print("nb of GOP:", nb_keys)
+        print("avr time :", round(sum(gop_time)/len(gop_time),6))
+        print("max time :", round(max(gop_time),6))
+        print("min time :", round(min(gop_time),6))
+        print("## GOP size in bytes.")
+        print("avr bytes:", round(sum(gop_bytes)/len(gop_bytes)))
+        print("max bytes:", max(gop_bytes))
+        print("min bytes:", min(gop_bytes))
+    else:
+        print("NOTE: no enough key frame found. len={}".format(nb_keys))
+    #
+    if opt.show_detail:
+        for frames in windows:
+            if len(windows) > 1 and len(frames):
+                print("## window from {}".format(frames.pts[0]))
+            show_detail(frames)
+
+def show_detail(frames):
+    jitter = frames.pts_jitter()
+    bps = frames.bitrate_per_second()
+    gaps = frames.dropped_gaps()
+    print("## frame interval in seconds.")
+    print("avr intv :", round(jitter["mean"],6))
+    print("jitter   :", round(jitter["stdev"],6))
+    print("max dev  :", round(jitter["max"],6))
+    print("VFR      :", frames.is_vfr())
+    print("nb of gap:", len(gaps))
+    for pts,gap in gaps[:10]:
+        print("  gap at {:.6f} for {:.6f}".format(pts, gap))
+    if bps:
+        # the last second may be partial.
+        full = bps[:-1] if len(bps) > 1 else bps
+        print("## bitrate per second in kbps.")
+        print("avr kbps :", round(sum(full)/len(full)/1000,3))
+        print("max kbps :", round(max(full)/1000,3))
+        print("min kbps :", round(min(full)/1000,3))
+    print("table    : {} frames in {} bytes".format(len(frames), frames.nbytes))
+
+def show_full():
+    """
+    read all the packets, or the frames with -D, of the file in constant
+    memory.  the series are written into the CSV files as they are closed.
+    """
+    files = []
+    def open_csv(path, header):
+        fd = open(path, "w", newline="")
+        files.append(fd)
+        writer = csv.writer(fd)
+        writer.writerow(header)
+        return writer
+    on_second = None
+    on_gop = None
+    if opt.csv_file:
+        sec_writer = open_csv(opt.csv_file, ["second", "bits"])
+        on_second = lambda sec, bits: sec_writer.writerow([sec, bits])
+    if opt.gop_csv_file:
+        gop_writer = open_csv(opt.gop_csv_file,
+                              ["pts", "duration", "frames", "bytes"])
+        on_gop = lambda pts, dur, nb, size: gop_writer.writerow(
+                [pts, round(dur, 6), nb, size])
+    stat = StreamStat(peak_windows=opt.peak_windows, on_second=on_second,
+                      on_gop=on_gop)
+    if opt.decode:
+        records = iter_frames(opt.input_file,
+                              entries=["key_frame", "pkt_pts_time",
+                                       "pkt_size"],
+                              verbose=opt.verbose)
+    else:
+        records = iter_packets(opt.input_file,
+                               entries=["pts_time", "size", "flags"],
+                               verbose=opt.verbose)
+    def to_float(v):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return math.nan
+    try:
+        with metrics.phase("analyze"):
+            if opt.decode:
+                for x in records:
+                    stat.add(to_float(x.get("pkt_pts_time")),
+                             int(x.get("pkt_size") or 0),
+                             x.get("key_frame") == "1")
+            else:
+                for x in records:
+                    stat.add(to_float(x.get("pts_time")),
+                             int(x.get("size") or 0),
+                             x.get("flags", "").startswith("K"))
+            stat.finish()
+    finally:
+        records.close()
+        for fd in files:
+            fd.close()
+    result = stat.to_dict()
+    if opt.json_file:
+        with open(opt.json_file, "w") as fd:
+            json.dump(result, fd, indent=2)
+    print("nb of frm:", result["nb_frames"])
+    print("nb of GOP:", result["nb_keys"])
+    for name,unit,k in [("GOP size in seconds.", "time", "gop_duration"),
+                        ("GOP size in bytes.", "bytes", "gop_bytes"),
+                        ("GOP size in frames.", "frms", "gop_frames")]:
+        x = result[k]
+        if not x["count"]:
+            continue
+        print(f"## {name}")
+        print("avr {:5}: {}".format(unit, round(x["mean"],6)))
+        print("max {:5}: {}".format(unit, round(x["max"],6)))
+        print("min {:5}: {}".format(unit, round(x["min"],6)))
+        print("std {:5}: {}".format(unit, round(x["stdev"],6)))
+    print("## key frame interval in frames.")
+    print("nb   Size")
+    print("==== ====")
+    for k,v in result["hist_gop_frames"]:
+        print("{:4} {:4}".format(v, k))
+    x = result["bitrate"]
+    if x["count"]:
+        print("## bitrate per second in kbps.")
+        print("avr kbps :", round(x["mean"]/1000,3))
+        print("max kbps :", round(x["max"]/1000,3))
+        print("min kbps :", round(x["min"]/1000,3))
+        for x in result["peak_bitrate"]:
+            print("peak {:3}s: {} kbps at {} sec".format(
+                    x["window"], round(x["bps"]/1000,3), x["start"]))
+    if result["nb_late"]:
+        print(f"WARNING: {result['nb_late']} frames came after "
+              "their second was closed.")
+
+def compare_time():
+    print("## elapsed time to read the frames.")
+    t0 = time.monotonic()
+    nb_packets = len(read_packets())
+    t1 = time.monotonic()
+    nb_frames = len(read_frames())
+    t2 = time.monotonic()
+    print("packet   : {:.3f} sec, {} packets".format(t1-t0, nb_packets))
+    print("frame    : {:.3f} sec, {} frames".format(t2-t1, nb_frames))
+    if t1 > t0:
+        print("speedup  : x{:.1f}".format((t2-t1)/(t1-t0)))
+
 #
 # main
 #
@@ -14,78 +280,75 @@ ap.add_argument("input_file", help="video file.")
 ap.add_argument("-N", action="store_false", dest="show_stat",
                 help="disable to show stat.")
 ap.add_argument("-p", action="store_true", dest="show_pattern",
-                help="show GOP patterns.")
+                help="show GOP patterns. it decodes the frames.")
+ap.add_argument("-D", action="store_true", dest="decode",
+                help="decode the frames to show the stat of GOP patterns. "
+                "by default, only the packets are read without decoding.")
+ap.add_argument("-d", action="store_true", dest="show_detail",
+                help="show the frame intervals, VFR, gaps and bitrate.")
+ap.add_argument("--compare", action="store_true", dest="compare_time",
+                help="show the time to read the packets and the frames.")
+ap.add_argument("-S", "--samples", action="store", dest="nb_samples",
+                type=int, default=0,
+                help="specify the number of windows evenly spaced across "
+                "the whole file to be read, instead of the first frames.")
+ap.add_argument("--sample-duration", action="store", dest="sample_duration",
+                type=float, default=20,
+                help="specify the duration of each window in seconds.")
+ap.add_argument("-j", action="store", dest="nb_jobs",
+                type=int, default=4,
+                help="specify the number of windows read in parallel.")
 ap.add_argument("--no-newline", action="store_false", dest="add_newline",
                 help="disable to add a new line before a key frame.")
 ap.add_argument("-F", "--frames", action="store", dest="max_frames",
                 type=int, default=10000,
                 help="specify max frames to be read.")
+ap.add_argument("--full", action="store_true", dest="full",
+                help="read the whole file in constant memory, "
+                "ignoring -F and -S.")
+ap.add_argument("--csv", action="store", dest="csv_file",
+                help="specify a file to write the bits per second "
+                "in CSV with --full.")
+ap.add_argument("--gop-csv", action="store", dest="gop_csv_file",
+                help="specify a file to write each GOP in CSV with --full.")
+ap.add_argument("--json", action="store", dest="json_file",
+                help="specify a file to write the stat in JSON with --full.")
+ap.add_argument("--peak-windows", action="store", dest="peak_windows",
+                type=lambda v: [int(x) for x in v.split(",")],
+                default=[1,10,60],
+                help="specify the widths in seconds of the windows "
+                "to find the peak bitrates, separated by comma.")
+add_probe_arguments(ap)
 ap.add_argument("-v", action="store_true", dest="verbose",
                 help="verbose mode.")
 opt = ap.parse_args()
+setup_probe(opt)
 
 ffinfo = get_stream_info(opt.input_file, codec_type="video",
                          verbose=opt.verbose)[0]
 
-frames = get_frames(opt.input_file, max_frames=opt.max_frames,
-                    entries=["key_frame", "pict_type", "pkt_pts_time"],
-                    verbose=opt.verbose)
+if opt.compare_time:
+    compare_time()
+    sys.exit(0)
 
-def tosymbol(x):
-    if x["key_frame"] == "1":
-        if x["pict_type"] == "I":
-            return "I"
-        else:
-            # NOTE: key frame and not pict_type, it should not be in case.
-            return "X"
-    else:
-        return x["pict_type"]
+if opt.full:
+    show_full()
+    sys.exit(0)
 
-if not opt.show_pattern:
-    print("nb   Size Pattern")
-    print("==== ==== =======")
-    patt_stat = {}
-    patt = [ tosymbol(frames[0]) ]
-    for x in frames[1:]:
-        if x["key_frame"] == "1":
-            p = "{}".format("".join(patt))
-            patt_stat.setdefault(p, 0)
-            patt_stat[p] += 1
-            patt = []
-        patt.append(tosymbol(x))
-    #
-    for k,v in patt_stat.items():
-        print("{:4} {:4} {}".format(v, len(k), k))
+if opt.show_pattern or opt.decode:
+    with metrics.phase("read"):
+        windows = read_windows(read_frames, ffinfo["duration"])
+    with metrics.phase("analyze"):
+        if opt.show_pattern:
+            show_pattern(windows)
+        else:
+            show_pattern_stat(windows)
 else:
-    print("Size Pattern")
-    print("==== =======")
-    if opt.add_newline:
-        nl = "\n"
-    else:
-        nl = ""
-    #
-    patt = [ tosymbol(frames[0]) ]
-    for x in frames[1:]:
-        if x["key_frame"] == "1":
-            sys.stdout.write("{:4} {}{}".format(len(patt),"".join(patt),nl))
-            patt = []
-        patt.append(tosymbol(x))
-    print()
+    with metrics.phase("read"):
+        windows = read_windows(read_packets, ffinfo["duration"])
+    with metrics.phase("analyze"):
+        show_size_stat(windows)
 
 if opt.show_stat:
-    gop = []
-    for x in frames:
-        if x.get("key_frame", "0") == "1":
-            if x["pict_type"] != "I":
-                print("WARNING: key frame, but type {}.".format(x["pict_type"]))
-            gop.append(float(x["pkt_pts_time"]))
-
-    if len(gop) > 1:
-        gop_time = [ b-a for a,b in zip(gop[:-1], gop[1:]) ]
-        print("## GOP size in seconds.")
-        print("nb of GOP:", len(gop))
-        print("avr time :", round(sum(gop_time)/len(gop_time),6))
-        print("max time :", round(max(gop_time),6))
-        print("min time :", round(min(gop_time),6))
-    else:
-        print("NOTE: no enough key frame found. len={}", len(gop))
+    with metrics.phase("analyze"):
+        show_stat(windows)
@@ -1,63 +1,277 @@
 #!/usr/bin/env python
 
+import sys
 import os
 from stat import S_ISDIR
-from fftools import get_stream_info, ffPrintInfo
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fftools import (get_stream_info, ffPrintInfo,
+                     add_probe_arguments, setup_probe, metrics,
+                     partial_hash, full_hash, keyframe_fingerprint,
+                     make_contact_sheet)
+from ffcatalog import Catalog
 import argparse
 
 MIN_BITRATE = 4000000
 MAX_BITRATE = 9999999999
 
-def print_info(path):
-    filename, ext = os.path.splitext(path)
-    if opt.prefixes is None or ext in opt.prefixes:
+def get_info(path):
+    """
+    return ffinfo of the path, or None if it is to be ignored.
+    it may be called in a worker thread.
+    """
+    ffinfo = get_stream_info(path, codec_type="video",
+                             verbose=opt.verbose)[0]
+    # check if ignore it.
+    if opt.check_bitrate:
         try:
-            ffinfo = get_stream_info(path, codec_type="video",
-                                     verbose=opt.verbose)[0]
-        except Exception as e:
-            if opt.verbose:
-                print("ERROR:", e)
-            return
-        # check if ignore it.
-        if opt.check_bitrate:
-            try:
-                bitrate = int(ffinfo["bit_rate"])
-            except KeyError:
-                pass
-            except ValueError:
-                pass
-            else:
-                if (bitrate > opt.max_bitrate or bitrate < opt.min_bitrate):
-                    # ignore it
-                    return
-        #
-        if opt.show_only_name:
+            bitrate = int(ffinfo["bit_rate"])
+        except KeyError:
+            pass
+        except ValueError:
+            pass
+        else:
+            if (bitrate > opt.max_bitrate or bitrate < opt.min_bitrate):
+                # ignore it
+                return None
+    for k,(a,b) in get_ranges().items():
+        v = ffinfo.get(FILTER_KEYS[k])
+        if v is None:
+            continue
+        if (a is not None and v < a) or (b is not None and v > b):
+            return None
+    if opt.profiles is not None and ffinfo.get("profile") not in opt.profiles:
+        return None
+    if opt.make_thumbs:
+        add_thumbnail(ffinfo)
+    return ffinfo
+
+def add_thumbnail(ffinfo):
+    """
+    put the path of the contact sheet into "thumbnail" of ffinfo.
+    it may be called in a worker thread.
+    """
+    path = ffinfo["path"]
+    try:
+        ffinfo["thumbnail"] = make_contact_sheet(
+                path, ffinfo["duration"], cols=opt.tile[0], rows=opt.tile[1],
+                width=opt.thumb_width, cache_dir=opt.thumbs_dir,
+                verbose=opt.verbose)
+    except Exception as e:
+        errors.append((path, f"thumbnail: {e}"))
+
+# the keys of ffinfo for the filters.
+FILTER_KEYS = {
+        "width": "coded_width",
+        "height": "coded_height",
+        "fps": "fps",
+        "duration": "duration",
+        }
+
+def get_ranges():
+    """
+    return the ranges of the filters specified, {name: (min, max)}.
+    """
+    ranges = {}
+    for k in FILTER_KEYS:
+        a = getattr(opt, f"min_{k}")
+        b = getattr(opt, f"max_{k}")
+        if a is not None or b is not None:
+            ranges[k] = (a, b)
+    return ranges
+
+def print_info(path, ffinfo):
+    if ffinfo is None:
+        return
+    if opt.show_only_name:
+        if opt.make_thumbs:
+            print("{}\t{}".format(path, ffinfo.get("thumbnail", "")),
+                  flush=True)
+        else:
             print(f"{path}", flush=True)
-            return
-        #
-        ffprint.print_info(ffinfo)
+        return
+    #
+    ffprint.print_info(ffinfo)
+    if ffinfo.get("thumbnail"):
+        print("  => {}".format(ffinfo["thumbnail"]))
 
 def walk_path(path, recursive=False):
+    """
+    yield the files to be probed in walk order.
+    """
     if opt.verbose:
         print(f"PATH: {path}")
     try:
         mode = os.stat(path).st_mode
     except Exception as e:
-        print(path, e)
+        errors.append((path, e))
         return
     #
     if not S_ISDIR(mode):
-        print_info(path)
+        filename, ext = os.path.splitext(path)
+        if opt.prefixes is None or ext in opt.prefixes:
+            yield path
+    else:
+        with metrics.phase("walk"):
+            with os.scandir(path) as fd:
+                entries = list(fd)
+            if opt.sort:
+                entries.sort(key=lambda x: x.name)
+        for entry in entries:
+            if entry.name.startswith(".."):
+                continue
+            elif entry.is_dir():
+                if recursive:
+                    yield from walk_path(entry.path, recursive)
+            else:
+                yield from walk_path(entry.path, recursive)
+
+def query_catalog():
+    """
+    show the files in the catalog.  the directories changed are rescanned
+    unless --no-scan is specified.
+    """
+    catalog = Catalog(verbose=opt.verbose)
+    if not opt.no_scan:
+        for f in opt.input_file:
+            errors.extend(catalog.scan(f, recursive=opt.recursively,
+                                       prefixes=opt.prefixes,
+                                       nb_jobs=opt.nb_jobs,
+                                       full=opt.full_scan))
+    filters = { "ext": opt.prefixes, "profile": opt.profiles }
+    if opt.check_bitrate:
+        filters["min_bit_rate"] = opt.min_bitrate
+        filters["max_bit_rate"] = opt.max_bitrate
+    for k,(a,b) in get_ranges().items():
+        filters[f"min_{k}"] = a
+        filters[f"max_{k}"] = b
+    infos = catalog.query(opt.input_file, recursive=opt.recursively, **filters)
+    if opt.make_thumbs:
+        def thumb(ffinfo):
+            add_thumbnail(ffinfo)
+            return ffinfo
+        with ThreadPoolExecutor(max_workers=opt.nb_jobs) as executor:
+            for ffinfo in executor.map(thumb, infos):
+                print_info(ffinfo["path"], ffinfo)
     else:
-        with os.scandir(path) as fd:
-            for entry in fd:
-                if entry.name.startswith(".."):
-                    continue
-                elif entry.is_dir():
-                    if recursive:
-                        walk_path(entry.path, recursive)
-                else:
-                    walk_path(entry.path, recursive)
+        for ffinfo in infos:
+            print_info(ffinfo["path"], ffinfo)
+    catalog.close()
+
+def probe_serial(paths, show=print_info):
+    for path in paths:
+        try:
+            ffinfo = get_info(path)
+        except Exception as e:
+            errors.append((path, e))
+            continue
+        show(path, ffinfo)
+
+def probe_parallel(paths, nb_jobs, show=print_info):
+    """
+    probe the files in a pool of nb_jobs threads while walking.
+    the rows are shown in walk order.  the number of pending probes
+    is bounded so that the walk doesn't run too far ahead.
+    """
+    def flush(pending):
+        path, fut = pending.popleft()
+        try:
+            ffinfo = fut.result()
+        except Exception as e:
+            errors.append((path, e))
+            return
+        show(path, ffinfo)
+    #
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+        for path in paths:
+            pending.append((path, executor.submit(get_info, path)))
+            while len(pending) > nb_jobs*4 or (pending and pending[0][1].done()):
+                flush(pending)
+        while pending:
+            flush(pending)
+
+def narrow(groups, key):
+    """
+    split each group by the key of each file, and return the groups
+    which have more than one file.  the files failed are left out.
+    """
+    def get_key(path):
+        try:
+            return key(path)
+        except Exception as e:
+            errors.append((path, e))
+            return None
+    result = []
+    with ThreadPoolExecutor(max_workers=opt.nb_jobs) as executor:
+        for group in groups:
+            sub = {}
+            for path,k in zip(group, executor.map(get_key, group)):
+                if k is not None:
+                    sub.setdefault(k, []).append(path)
+            result.extend([ x for x in sub.values() if len(x) > 1 ])
+    return result
+
+def find_duplicates(paths):
+    """
+    show the groups of the same files, and of the same video in the
+    different files.  the candidates are narrowed in the cheap stages
+    first, so the most of the files are never read.
+        identical: the size, a partial hash, then the full hash.
+            the files are not probed, so the filters are not applied.
+        same video: the stream signature from the probe result, then
+            the sizes of the packets around some key frames.
+    """
+    # the same paths found through the different arguments.
+    files = {}
+    for path in paths:
+        files.setdefault(os.path.realpath(path), path)
+    sizes = {}
+    for path in files.values():
+        try:
+            sizes[path] = os.stat(path).st_size
+        except OSError as e:
+            errors.append((path, e))
+    # identical files.
+    by_size = {}
+    for path,size in sizes.items():
+        by_size.setdefault(size, []).append(path)
+    groups = [ x for x in by_size.values() if len(x) > 1 ]
+    groups = narrow(groups, partial_hash)
+    if not opt.dup_quick:
+        groups = narrow(groups, full_hash)
+    identical = groups
+    # the same video.  the copies identical are represented by one of them,
+    # and only the others are probed.
+    others = set([ path for x in identical for path in x[1:] ])
+    infos = {}
+    def collect(path, ffinfo):
+        if ffinfo is not None:
+            infos[path] = ffinfo
+    candidates = [ path for path in sizes if path not in others ]
+    if opt.nb_jobs > 1:
+        probe_parallel(candidates, opt.nb_jobs, show=collect)
+    else:
+        probe_serial(candidates, show=collect)
+    by_sig = {}
+    for path,x in infos.items():
+        sig = (x.get("codec_name"), x.get("coded_width"),
+               x.get("coded_height"), round(x.get("fps", 0)),
+               round(x.get("duration", 0)))
+        by_sig.setdefault(sig, []).append(path)
+    groups = [ x for x in by_sig.values() if len(x) > 1 ]
+    same_video = narrow(groups, lambda path: keyframe_fingerprint(
+            path, infos[path]["duration"], verbose=opt.verbose))
+    #
+    for name,groups in [("identical", identical),
+                        ("same video", same_video)]:
+        for group in groups:
+            print("## {}: {} files".format(name, len(group)))
+            for path in sorted(group):
+                print("  {} {:.1f} MB".format(path,
+                                             sizes[path] / 1000000))
+    print("## {} files, {} identical groups, {} same video groups.".format(
+            len(files), len(identical), len(same_video)))
 
 # main
 ap = argparse.ArgumentParser(
@@ -81,27 +295,91 @@ ap.add_argument("-p", action="store", dest="prefixes",
                 default="mp4,mkv,avi,flv,vob,wmv,mov,mpg,m4v,webm",
                 help="specify prefixes to show, comma separated. "
                 "e.g. mp4,flv")
+for k,t in [("width", int), ("height", int), ("fps", float),
+            ("duration", float)]:
+    ap.add_argument(f"--min-{k}", action="store", dest=f"min_{k}",
+                    type=t, help=f"specify minimum {k} of a file to show.")
+    ap.add_argument(f"--max-{k}", action="store", dest=f"max_{k}",
+                    type=t, help=f"specify maximum {k} of a file to show.")
+ap.add_argument("--profile", action="store", dest="profiles",
+                help="specify profiles of a file to show, comma separated. "
+                "e.g. High,Main")
 ap.add_argument("-n", action="store_true", dest="show_only_name",
                 help="enable to show the list of files.")
 ap.add_argument("-r", action="store_true", dest="recursively",
                 help="enable to recursively search the directory.")
+ap.add_argument("-s", action="store_true", dest="sort",
+                help="sort the entries of each directory by name.")
+ap.add_argument("-j", action="store", dest="nb_jobs",
+                type=int, default=1,
+                help="specify the number of files probed in parallel.")
+ap.add_argument("--dup", action="store_true", dest="find_dup",
+                help="show the duplicates instead of the list.")
+ap.add_argument("--dup-quick", action="store_true", dest="dup_quick",
+                help="don't read the whole files to confirm the identical "
+                "files found by the partial hashes.")
+ap.add_argument("--thumbs", action="store_true", dest="make_thumbs",
+                help="make a contact sheet of the key frames of each file. "
+                "use -j to make them in parallel.")
+ap.add_argument("--thumbs-dir", action="store", dest="thumbs_dir",
+                help="specify the directory of the contact sheets. "
+                "~/.cache/fftools/thumbs by default.")
+ap.add_argument("--tile", action="store", dest="tile",
+                type=lambda v: [int(x) for x in v.split("x")],
+                default=[4,4],
+                help="specify the columns and rows of a contact sheet.")
+ap.add_argument("--thumb-width", action="store", dest="thumb_width",
+                type=int, default=320,
+                help="specify the width of each thumbnail.")
+add_probe_arguments(ap)
+ap.add_argument("--catalog", action="store_true", dest="use_catalog",
+                help="list the files from the catalog.  only the directories "
+                "changed since the last scan are scanned.")
+ap.add_argument("--no-scan", action="store_true", dest="no_scan",
+                help="list the files from the catalog without scanning.")
+ap.add_argument("--full-scan", action="store_true", dest="full_scan",
+                help="check all files to update the catalog.")
 ap.add_argument("-v", action="store_true", dest="verbose",
                 help="enable verbose mode.")
 opt = ap.parse_args()
+setup_probe(opt)
 
 opt.print_mode = len(opt._print_mode)
 opt.prefixes = [ f".{x}" for x in opt.prefixes.split(",") ]
+if opt.profiles is not None:
+    opt.profiles = opt.profiles.split(",")
+if opt.no_scan or opt.full_scan:
+    opt.use_catalog = True
 if opt.x_bitrate:
     opt.max_bitrate = 4100000
     opt.min_bitrate = 3900000
 
 # header
 ffprint = ffPrintInfo(print_mode=opt.print_mode, verbose=opt.verbose)
-ffprint.print_header()
+if not opt.find_dup:
+    ffprint.print_header()
 
 # body
+errors = []
 if len(opt.input_file) == 0:
     opt.input_file = ["."]
-for f in opt.input_file:
-    walk_path(f, recursive=opt.recursively)
+if opt.find_dup:
+    find_duplicates(path for f in opt.input_file
+                    for path in walk_path(f, recursive=opt.recursively))
+elif opt.use_catalog:
+    query_catalog()
+else:
+    paths = (path for f in opt.input_file
+             for path in walk_path(f, recursive=opt.recursively))
+    if opt.nb_jobs > 1:
+        probe_parallel(paths, opt.nb_jobs)
+    else:
+        probe_serial(paths)
 
+# errors
+if errors:
+    for path, e in errors:
+        print(f"ERROR: {path}: {e}", file=sys.stderr)
+    print(f"ERROR: {len(errors)} file(s) could not be probed.",
+          file=sys.stderr)
+    sys.exit(1)
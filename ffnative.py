@@ -0,0 +1,395 @@
+#
+# parser of the headers of MP4/MOV and Matroska/WebM files.
+# it returns the video streams in the same form as ffprobe -show_streams
+# so that fftools.get_stream_info() can use it instead of ffprobe.
+# only the moov box or the Info and Tracks elements are read through mmap.
+#
+import os
+import sys
+import mmap
+import math
+import struct
+from array import array
+from fractions import Fraction
+
+class NotSupported(Exception):
+    pass
+
+H264_PROFILES = {
+        44: "CAVLC 4:4:4",
+        66: "Baseline",
+        77: "Main",
+        88: "Extended",
+        100: "High",
+        110: "High 10",
+        118: "Multiview High",
+        122: "High 4:2:2",
+        128: "Stereo High",
+        244: "High 4:4:4 Predictive",
+        }
+
+HEVC_PROFILES = {
+        1: "Main",
+        2: "Main 10",
+        3: "Main Still Picture",
+        4: "Rext",
+        }
+
+MP4_CODECS = {
+        b"avc1": "h264",
+        b"avc3": "h264",
+        b"hvc1": "hevc",
+        b"hev1": "hevc",
+        b"mp4v": "mpeg4",
+        b"av01": "av1",
+        b"vp09": "vp9",
+        }
+
+MKV_CODECS = {
+        "V_MPEG4/ISO/AVC": "h264",
+        "V_MPEGH/ISO/HEVC": "hevc",
+        "V_MPEG4/ISO/ASP": "mpeg4",
+        "V_AV1": "av1",
+        "V_VP9": "vp9",
+        "V_VP8": "vp8",
+        }
+
+def probe(input_file):
+    """
+    return a dict like the output of ffprobe -show_streams with
+    the video streams only.
+    raise NotSupported if the container is not supported.
+    """
+    with open(input_file, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size < 16:
+            raise NotSupported("too short.")
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:4] == b"\x1a\x45\xdf\xa3":
+                streams = probe_mkv(m)
+            elif m[4:8] in [b"ftyp", b"moov", b"mdat", b"wide", b"free"]:
+                streams = probe_mp4(m)
+            else:
+                raise NotSupported("unknown container.")
+    if not streams:
+        raise NotSupported("no video stream.")
+    # the fields make_stream_info() needs.  ffprobe is used if any is missing.
+    for x in streams:
+        for k in ["profile", "level", "r_frame_rate", "duration"]:
+            if k not in x:
+                raise NotSupported(f"no {k}.")
+        if x["r_frame_rate"].endswith("/0"):
+            raise NotSupported("no frame rate.")
+        if float(x["duration"]) == 0:
+            raise NotSupported("no duration.")
+    return {"streams": streams}
+
+def _fraction(a, b):
+    f = Fraction(int(a), int(b))
+    return f"{f.numerator}/{f.denominator}"
+
+def _aspect_ratio(width, height, sar_w=1, sar_h=1):
+    if not (width and height and sar_w and sar_h):
+        return None
+    f = Fraction(width*sar_w, height*sar_h)
+    return f"{f.numerator}:{f.denominator}"
+
+def _avc_profile(config):
+    """
+    config: AVCDecoderConfigurationRecord.
+    """
+    if len(config) < 4:
+        return {}
+    profile_idc, compat, level_idc = config[1], config[2], config[3]
+    profile = H264_PROFILES.get(profile_idc, str(profile_idc))
+    if profile_idc == 66 and compat & 0x40:
+        profile = "Constrained Baseline"
+    elif profile_idc == 110 and compat & 0x10:
+        profile = "High 10 Intra"
+    return {"profile": profile, "level": level_idc}
+
+def _hevc_profile(config):
+    """
+    config: HEVCDecoderConfigurationRecord.
+    """
+    if len(config) < 13:
+        return {}
+    profile_idc = config[1] & 0x1f
+    return {"profile": HEVC_PROFILES.get(profile_idc, str(profile_idc)),
+            "level": config[12]}
+
+#
+# MP4
+#
+def _boxes(m, start, end):
+    """
+    yield (type, start of the payload, end of the box).
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, btype = struct.unpack_from(">I4s", m, pos)
+        hdr = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", m, pos+8)[0]
+            hdr = 16
+        elif size == 0:
+            size = end - pos
+        if size < hdr:
+            raise NotSupported("broken box.")
+        yield btype, pos + hdr, min(pos + size, end)
+        pos += size
+
+def _find(m, start, end, path):
+    """
+    return (start, end) of the first box of the path, or None.
+    path: a list of box types, e.g. [b"mdia", b"minf"].
+    """
+    for btype, s, e in _boxes(m, start, end):
+        if btype == path[0]:
+            if len(path) == 1:
+                return s, e
+            return _find(m, s, e, path[1:])
+    return None
+
+def probe_mp4(m):
+    moov = _find(m, 0, len(m), [b"moov"])
+    if moov is None:
+        raise NotSupported("no moov box.")
+    streams = []
+    index = 0
+    for btype, s, e in _boxes(m, *moov):
+        if btype != b"trak":
+            continue
+        stream = _probe_trak(m, s, e)
+        if stream is not None:
+            stream["index"] = index
+            streams.append(stream)
+        index += 1
+    return streams
+
+def _probe_trak(m, start, end):
+    mdia = _find(m, start, end, [b"mdia"])
+    if mdia is None:
+        return None
+    hdlr = _find(m, *mdia, [b"hdlr"])
+    if hdlr is None or m[hdlr[0]+8:hdlr[0]+12] != b"vide":
+        return None
+    # mdhd
+    mdhd = _find(m, *mdia, [b"mdhd"])
+    if mdhd is None:
+        raise NotSupported("no mdhd box.")
+    if m[mdhd[0]] == 1:
+        timescale, duration = struct.unpack_from(">IQ", m, mdhd[0]+20)
+    else:
+        timescale, duration = struct.unpack_from(">II", m, mdhd[0]+12)
+    stbl = _find(m, *mdia, [b"minf", b"stbl"])
+    if stbl is None or not timescale:
+        raise NotSupported("no stbl box.")
+    stream = {"codec_type": "video"}
+    stream["duration"] = str(duration / timescale)
+    # stsd: the first sample entry.
+    stsd = _find(m, *stbl, [b"stsd"])
+    if stsd is None:
+        raise NotSupported("no stsd box.")
+    for fourcc, s, e in _boxes(m, stsd[0]+8, stsd[1]):
+        stream["codec_name"] = MP4_CODECS.get(fourcc,
+                                              fourcc.decode(errors="replace"))
+        stream["codec_tag_string"] = fourcc.decode(errors="replace")
+        width, height = struct.unpack_from(">HH", m, s+24)
+        stream.update({"width": width, "height": height,
+                       "coded_width": width, "coded_height": height})
+        sar = (1, 1)
+        for ctype, cs, ce in _boxes(m, s+78, e):
+            if ctype == b"avcC":
+                stream.update(_avc_profile(m[cs:ce]))
+            elif ctype == b"hvcC":
+                stream.update(_hevc_profile(m[cs:ce]))
+            elif ctype == b"pasp":
+                sar = struct.unpack_from(">II", m, cs)
+        stream["sample_aspect_ratio"] = "{}:{}".format(*sar)
+        ar = _aspect_ratio(width, height, *sar)
+        if ar is not None:
+            stream["display_aspect_ratio"] = ar
+        break
+    # stts: the number of frames and the frame rate.
+    stts = _find(m, *stbl, [b"stts"])
+    if stts is not None:
+        nb_entries = struct.unpack_from(">I", m, stts[0]+4)[0]
+        entries = array("I", m[stts[0]+8:stts[0]+8+nb_entries*8])
+        if sys.byteorder == "little":
+            entries.byteswap()
+        nb_frames = sum(entries[0::2])
+        stream["nb_frames"] = str(nb_frames)
+        if nb_entries == 1 and entries[1]:
+            stream["r_frame_rate"] = _fraction(timescale, entries[1])
+        if duration:
+            stream["avg_frame_rate"] = _fraction(nb_frames*timescale,
+                                                 duration)
+            stream.setdefault("r_frame_rate", stream["avg_frame_rate"])
+    # stsz: the size of the stream for the bit rate.
+    stsz = _find(m, *stbl, [b"stsz"])
+    if stsz is not None and duration:
+        sample_size, nb_samples = struct.unpack_from(">II", m, stsz[0]+4)
+        if sample_size:
+            total = sample_size * nb_samples
+        else:
+            sizes = array("I", m[stsz[0]+12:stsz[0]+12+nb_samples*4])
+            if sys.byteorder == "little":
+                sizes.byteswap()
+            total = sum(sizes)
+        stream["bit_rate"] = str(int(total*8*timescale/duration))
+    return stream
+
+#
+# Matroska
+#
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMESTAMP_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_CODEC_PRIVATE = 0x63A2
+MKV_DEFAULT_DURATION = 0x23E383
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_DISPLAY_WIDTH = 0x54B0
+MKV_DISPLAY_HEIGHT = 0x54BA
+MKV_DISPLAY_UNIT = 0x54B2
+MKV_CLUSTER = 0x1F43B675
+
+def _vint(m, pos, keep_marker):
+    """
+    return (value, length) of the variable length integer at pos.
+    """
+    first = m[pos]
+    if first == 0:
+        raise NotSupported("broken element.")
+    length = 8 - first.bit_length() + 1
+    value = first if keep_marker else first & ((1 << (8 - length)) - 1)
+    for i in range(1, length):
+        value = (value << 8) | m[pos+i]
+    return value, length
+
+def _elements(m, start, end):
+    """
+    yield (id, start of the data, end of the element).
+    the end of an element of unknown size is the end of the parent.
+    """
+    pos = start
+    while pos < end:
+        eid, n = _vint(m, pos, True)
+        size, k = _vint(m, pos+n, False)
+        data = pos + n + k
+        if size == (1 << (7*k)) - 1:
+            # unknown size.
+            size = end - data
+        yield eid, data, min(data + size, end)
+        pos = data + size
+
+def _uint(m, s, e):
+    return int.from_bytes(m[s:e], "big")
+
+def _float(m, s, e):
+    if e - s == 4:
+        return struct.unpack_from(">f", m, s)[0]
+    elif e - s == 8:
+        return struct.unpack_from(">d", m, s)[0]
+    return math.nan
+
+def probe_mkv(m):
+    segment = None
+    for eid, s, e in _elements(m, 0, len(m)):
+        if eid == MKV_SEGMENT:
+            segment = (s, e)
+            break
+    if segment is None:
+        raise NotSupported("no segment.")
+    timestamp_scale = 1000000
+    duration = None
+    tracks = None
+    for eid, s, e in _elements(m, *segment):
+        if eid == MKV_INFO:
+            for cid, cs, ce in _elements(m, s, e):
+                if cid == MKV_TIMESTAMP_SCALE:
+                    timestamp_scale = _uint(m, cs, ce)
+                elif cid == MKV_DURATION:
+                    duration = _float(m, cs, ce)
+        elif eid == MKV_TRACKS:
+            tracks = (s, e)
+        elif eid == MKV_CLUSTER:
+            break
+        if tracks is not None and duration is not None:
+            break
+    if tracks is None:
+        raise NotSupported("no tracks before the clusters.")
+    streams = []
+    index = 0
+    for eid, s, e in _elements(m, *tracks):
+        if eid != MKV_TRACK_ENTRY:
+            continue
+        stream = _probe_track_entry(m, s, e)
+        index += 1
+        if stream is None:
+            continue
+        stream["index"] = index - 1
+        if duration is not None:
+            stream["duration"] = str(duration*timestamp_scale/1e9)
+        streams.append(stream)
+    return streams
+
+def _probe_track_entry(m, start, end):
+    stream = {"codec_type": "video"}
+    video = None
+    track_type = None
+    codec_id = None
+    for eid, s, e in _elements(m, start, end):
+        if eid == MKV_TRACK_TYPE:
+            track_type = _uint(m, s, e)
+        elif eid == MKV_CODEC_ID:
+            codec_id = m[s:e].rstrip(b"\0").decode(errors="replace")
+        elif eid == MKV_CODEC_PRIVATE:
+            stream["codec_private"] = (s, e)
+        elif eid == MKV_DEFAULT_DURATION:
+            ns = _uint(m, s, e)
+            if ns:
+                f = Fraction(1000000000, ns).limit_denominator(1001)
+                stream["r_frame_rate"] = f"{f.numerator}/{f.denominator}"
+                stream["avg_frame_rate"] = stream["r_frame_rate"]
+        elif eid == MKV_VIDEO:
+            video = (s, e)
+    if track_type != 1 or video is None:
+        return None
+    stream["codec_name"] = MKV_CODECS.get(codec_id, codec_id)
+    private = stream.pop("codec_private", None)
+    if private is not None:
+        if stream["codec_name"] == "h264":
+            stream.update(_avc_profile(m[private[0]:private[1]]))
+        elif stream["codec_name"] == "hevc":
+            stream.update(_hevc_profile(m[private[0]:private[1]]))
+    width = height = dwidth = dheight = None
+    display_unit = 0
+    for eid, s, e in _elements(m, *video):
+        if eid == MKV_PIXEL_WIDTH:
+            width = _uint(m, s, e)
+        elif eid == MKV_PIXEL_HEIGHT:
+            height = _uint(m, s, e)
+        elif eid == MKV_DISPLAY_WIDTH:
+            dwidth = _uint(m, s, e)
+        elif eid == MKV_DISPLAY_HEIGHT:
+            dheight = _uint(m, s, e)
+        elif eid == MKV_DISPLAY_UNIT:
+            display_unit = _uint(m, s, e)
+    if not (width and height):
+        raise NotSupported("no size of the video.")
+    stream.update({"width": width, "height": height,
+                   "coded_width": width, "coded_height": height})
+    if display_unit == 0 and dwidth and dheight:
+        ar = _aspect_ratio(dwidth, dheight)
+    else:
+        ar = _aspect_ratio(width, height)
+    stream["display_aspect_ratio"] = ar
+    return stream
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import time
+import socket
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fftools import (SOCKET_PATH, ProbeCache, probe_streams,
+                     set_probe_remote, add_metrics_arguments, setup_metrics)
+import argparse
+
+class ProbeHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        """
+        a request and a response are a JSON object in a line.
+        the connection may carry multiple requests.
+        """
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+                res = self.server.dispatch(req)
+            except Exception as e:
+                res = {"error": str(e)}
+            self.wfile.write(json.dumps(res).encode() + b"\n")
+            self.wfile.flush()
+            if res.get("shutdown"):
+                break
+
+class ProbeServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, nb_jobs, verbose=False):
+        """
+        the cache and the pool of workers are kept while it is running.
+        """
+        super().__init__(path, ProbeHandler)
+        self.verbose = verbose
+        self.cache = ProbeCache(verbose=verbose)
+        self.executor = ThreadPoolExecutor(max_workers=nb_jobs)
+        self.stats = {"requests": 0, "hits": 0, "probes": 0, "errors": 0,
+                      "started": time.time()}
+        self.lock = threading.Lock()
+
+    def server_bind(self):
+        # the socket is created only for the user.  it isn't changed by
+        # chmod after bind() not to be open to the others in the meantime.
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def dispatch(self, req):
+        op = req.get("op")
+        self.count("requests")
+        if op == "probe":
+            return {"result": self.probe(req["path"], req.get("refresh"))}
+        elif op == "ping":
+            return {"result": "pong"}
+        elif op == "stats":
+            return {"result": dict(self.stats, lru=len(self.cache.lru))}
+        elif op == "shutdown":
+            threading.Thread(target=self.shutdown).start()
+            return {"result": "bye", "shutdown": True}
+        raise ValueError(f"unknown op {op}")
+
+    def probe(self, path, refresh=False):
+        if not refresh:
+            result = self.cache.get(path)
+            if result is not None:
+                self.count("hits")
+                return result
+        self.count("probes")
+        try:
+            result = self.executor.submit(probe_streams, path,
+                                          verbose=self.verbose).result()
+        except Exception:
+            self.count("errors")
+            raise
+        self.cache.put(path, result)
+        return result
+
+def request(op):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(opt.socket_path)
+        s.sendall(json.dumps({"op": op}).encode() + b"\n")
+        with s.makefile("rb") as fd:
+            return json.loads(fd.readline())
+
+def serve():
+    try:
+        request("ping")
+    except OSError:
+        # not running.  remove the socket left.
+        if os.path.exists(opt.socket_path):
+            os.unlink(opt.socket_path)
+    else:
+        print(f"ERROR: already running on {opt.socket_path}")
+        sys.exit(1)
+    os.makedirs(os.path.dirname(os.path.abspath(opt.socket_path)),
+                exist_ok=True)
+    server = ProbeServer(opt.socket_path, opt.nb_jobs, verbose=opt.verbose)
+    print(f"## listening on {opt.socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.cache.close()
+        os.unlink(opt.socket_path)
+
+#
+# main
+#
+ap = argparse.ArgumentParser(
+        description="serve the probe results to the other tools "
+        "through a unix socket, keeping the cache and the workers warm.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+ap.add_argument("--stop", action="store_const", dest="op", const="shutdown",
+                help="stop the service.")
+ap.add_argument("--status", action="store_const", dest="op", const="stats",
+                help="show the status of the service.")
+ap.add_argument("-j", action="store", dest="nb_jobs",
+                type=int, default=8,
+                help="specify the number of ffprobe run in parallel.")
+ap.add_argument("--socket", action="store", dest="socket_path",
+                default=SOCKET_PATH,
+                help="specify the path of the unix socket.")
+add_metrics_arguments(ap)
+ap.add_argument("-v", action="store_true", dest="verbose",
+                help="enable verbose mode.")
+opt = ap.parse_args()
+setup_metrics(opt)
+
+# never ask itself.
+set_probe_remote(False)
+
+if opt.op is None:
+    serve()
+else:
+    try:
+        res = request(opt.op)
+    except OSError as e:
+        print(f"ERROR: not running. {e}")
+        sys.exit(1)
+    print("\n".join([ "{}={}".format(*a) for a in res["result"].items() ])
+          if isinstance(res["result"], dict) else res["result"])
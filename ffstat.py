@@ -0,0 +1,412 @@
+import math
+from array import array
+from itertools import islice
+from collections import deque
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# code of pict_type.  0 means unknown.
+PICT_TYPES = "?IPBS"
+
+def _float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return math.nan
+
+def _median(values):
+    v = sorted(values)
+    if not v:
+        return math.nan
+    n = len(v)
+    return v[n//2] if n % 2 else (v[n//2-1] + v[n//2]) / 2
+
+class FrameTable():
+
+    def __init__(self):
+        """
+        columnar table of frames or packets.
+        pts, dts: in seconds, nan if not available.
+        size: in bytes.
+        key: 1 if it is a key frame.
+        pict: index of pict_type in PICT_TYPES.
+        the helpers use numpy if it is available.
+        """
+        self.pts = array("d")
+        self.dts = array("d")
+        self.size = array("I")
+        self.key = array("B")
+        self.pict = array("B")
+
+    def __len__(self):
+        return len(self.pts)
+
+    @property
+    def nbytes(self):
+        return sum([c.itemsize*len(c) for c in
+                    [self.pts, self.dts, self.size, self.key, self.pict]])
+
+    def append(self, pts, dts, size, key, pict_type="?"):
+        self.pts.append(pts)
+        self.dts.append(dts)
+        self.size.append(size)
+        self.key.append(key)
+        self.pict.append(max(PICT_TYPES.find(pict_type), 0))
+
+    @classmethod
+    def from_frames(cls, frames, max_frames=0):
+        """
+        frames: iterable of dicts from fftools.iter_frames().
+        """
+        t = cls()
+        if max_frames:
+            frames = islice(frames, max_frames)
+        for x in frames:
+            t.append(_float(x.get("pkt_pts_time", x.get("pts_time"))),
+                     _float(x.get("pkt_dts_time", x.get("dts_time"))),
+                     int(x.get("pkt_size", "0") or 0),
+                     1 if x.get("key_frame") == "1" else 0,
+                     x.get("pict_type", "?"))
+        return t
+
+    @classmethod
+    def from_packets(cls, packets, max_packets=0):
+        """
+        packets: iterable of dicts from fftools.iter_packets().
+        """
+        t = cls()
+        if max_packets:
+            packets = islice(packets, max_packets)
+        for x in packets:
+            t.append(_float(x.get("pts_time")),
+                     _float(x.get("dts_time")),
+                     int(x.get("size", "0") or 0),
+                     1 if x.get("flags", "").startswith("K") else 0)
+        return t
+
+    def column(self, name):
+        """
+        return the column as a numpy array without copy if numpy is
+        available.  otherwise, return the array as it is.
+        """
+        c = getattr(self, name)
+        if np is None:
+            return c
+        return np.frombuffer(c, dtype=c.typecode) if len(c) else np.array(
+                [], dtype=c.typecode)
+
+    def symbols(self):
+        """
+        yield the symbol of each frame, i.e. pict_type,
+        or "X" if it is a key frame but not "I".
+        """
+        for k,p in zip(self.key, self.pict):
+            if k and p != 1:
+                yield "X"
+            else:
+                yield PICT_TYPES[p]
+
+    def key_index(self):
+        """
+        return the indexes of the key frames.
+        """
+        if np is not None:
+            return np.flatnonzero(self.column("key"))
+        return [ i for i,k in enumerate(self.key) if k ]
+
+    def gop_lengths(self):
+        """
+        return the number of frames of each GOP.
+        the frames before the first key frame and the last GOP,
+        which may be truncated, are not counted.
+        """
+        ki = self.key_index()
+        if np is not None:
+            return np.diff(ki)
+        return [ b-a for a,b in zip(ki[:-1], ki[1:]) ]
+
+    def gop_durations(self):
+        """
+        return the duration in seconds of each GOP.  see gop_lengths().
+        """
+        ki = self.key_index()
+        if np is not None:
+            return np.diff(self.column("pts")[ki])
+        return [ self.pts[b]-self.pts[a] for a,b in zip(ki[:-1], ki[1:]) ]
+
+    def gop_bytes(self):
+        """
+        return the size in bytes of each GOP.  see gop_lengths().
+        """
+        ki = self.key_index()
+        if len(ki) < 2:
+            return []
+        if np is not None:
+            return np.add.reduceat(self.column("size").astype(np.int64),
+                                   ki)[:-1]
+        return [ sum(self.size[a:b]) for a,b in zip(ki[:-1], ki[1:]) ]
+
+    def _sorted_pts(self):
+        """
+        return pts in presentation order without nan.
+        """
+        if np is not None:
+            pts = self.column("pts")
+            return np.sort(pts[~np.isnan(pts)])
+        return sorted([ x for x in self.pts if not math.isnan(x) ])
+
+    def frame_intervals(self):
+        """
+        return the intervals between the frames in presentation order.
+        """
+        pts = self._sorted_pts()
+        if np is not None:
+            return np.diff(pts)
+        return [ b-a for a,b in zip(pts[:-1], pts[1:]) ]
+
+    def pts_jitter(self):
+        """
+        return a dict of the mean, the standard deviation and
+        the maximum absolute deviation of the frame intervals.
+        """
+        d = self.frame_intervals()
+        if len(d) == 0:
+            return {"mean": math.nan, "stdev": math.nan, "max": math.nan}
+        if np is not None:
+            mean = float(d.mean())
+            return {"mean": mean, "stdev": float(d.std()),
+                    "max": float(np.abs(d - mean).max())}
+        mean = sum(d) / len(d)
+        return {"mean": mean,
+                "stdev": math.sqrt(sum([(x-mean)**2 for x in d]) / len(d)),
+                "max": max([abs(x-mean) for x in d])}
+
+    def is_vfr(self, tolerance=0.01):
+        """
+        return True if any frame interval differs from the median
+        by more than the tolerance in ratio.
+        """
+        d = self.frame_intervals()
+        if len(d) == 0:
+            return False
+        if np is not None:
+            m = float(np.median(d))
+            return bool(np.any(np.abs(d - m) > m*tolerance))
+        m = _median(d)
+        return any([abs(x-m) > m*tolerance for x in d])
+
+    def bitrate_per_second(self):
+        """
+        return a list of bits in each second from the first pts.
+        """
+        if np is not None:
+            pts = self.column("pts")
+            valid = ~np.isnan(pts)
+            if not valid.any():
+                return []
+            pts = pts[valid]
+            sec = (pts - pts.min()).astype(np.int64)
+            bits = self.column("size")[valid].astype(np.float64)*8
+            return np.bincount(sec, weights=bits).astype(np.int64).tolist()
+        pts = [ (p,s) for p,s in zip(self.pts, self.size) if not math.isnan(p) ]
+        if not pts:
+            return []
+        p0 = min([p for p,s in pts])
+        bps = [0]*(int(max([p for p,s in pts]) - p0) + 1)
+        for p,s in pts:
+            bps[int(p - p0)] += s*8
+        return bps
+
+    def dropped_gaps(self, factor=1.5):
+        """
+        return a list of (pts, gap) where the interval to the next frame
+        is more than factor times the median interval.
+        """
+        pts = self._sorted_pts()
+        d = self.frame_intervals()
+        if len(d) == 0:
+            return []
+        if np is not None:
+            m = float(np.median(d))
+            idx = np.flatnonzero(d > m*factor)
+            return [ (float(pts[i]), float(d[i])) for i in idx ]
+        m = _median(d)
+        return [ (pts[i], x) for i,x in enumerate(d) if x > m*factor ]
+
+class RunningStat():
+
+    def __init__(self):
+        """
+        count, mean, standard deviation, min and max of the values
+        added one by one, in constant memory.
+        """
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = math.nan
+        self.max = math.nan
+
+    def add(self, v):
+        self.count += 1
+        d = v - self.mean
+        self.mean += d / self.count
+        self.m2 += d * (v - self.mean)
+        if self.count == 1:
+            self.min = self.max = v
+        else:
+            self.min = min(self.min, v)
+            self.max = max(self.max, v)
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.m2 / self.count) if self.count else math.nan
+
+    def to_dict(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean": self.mean, "stdev": self.stdev,
+                "min": self.min, "max": self.max}
+
+class StreamStat():
+
+    def __init__(self, peak_windows=[1], reorder=2, on_second=None,
+                 on_gop=None):
+        """
+        online statistics of the frames or packets of a file of any length
+        in constant memory.  feed them by add() in decode order, then call
+        finish().
+        the bits are put into the second of pts from the first pts.
+        a second is closed when a pts later than it by reorder seconds
+        comes, so reorder must cover the delay of the B frames.
+        peak_windows: the widths in seconds of the sliding windows
+            to find the peak bitrates.
+        on_second(sec, bits): called when a second is closed.
+        on_gop(pts, duration, nb_frames, nb_bytes): called when a GOP is
+            closed.  the last GOP, which may be truncated, is not closed.
+        """
+        self.reorder = reorder
+        self.on_second = on_second
+        self.on_gop = on_gop
+        self.nb_frames = 0
+        self.nb_bytes = 0
+        self.nb_keys = 0
+        self.nb_late = 0
+        self.t0 = None
+        self.max_pts = -math.inf
+        # the seconds not closed yet.  sec: bits
+        self.open_secs = {}
+        self.next_sec = 0
+        self.bitrate = RunningStat()
+        # width: [window of bits, sum of the window, peak, start of the peak]
+        self.peaks = { w: [deque(maxlen=w), 0, 0, None]
+                       for w in peak_windows }
+        self.gop_pts = None
+        self.gop_frames = 0
+        self.gop_nb_bytes = 0
+        self.gop_duration = RunningStat()
+        self.gop_size = RunningStat()
+        self.gop_length = RunningStat()
+        # histograms of the key frame interval in frames and in 10 msec.
+        self.hist_frames = {}
+        self.hist_duration = {}
+
+    def add(self, pts, size, key):
+        """
+        pts: in seconds, nan if not available.
+        size: in bytes.
+        key: True if it is a key frame.
+        """
+        self.nb_frames += 1
+        self.nb_bytes += size
+        if key:
+            self.nb_keys += 1
+            if self.gop_pts is not None:
+                self._close_gop(pts)
+            self.gop_pts = pts
+            self.gop_frames = 0
+            self.gop_nb_bytes = 0
+        self.gop_frames += 1
+        self.gop_nb_bytes += size
+        if math.isnan(pts):
+            return
+        if self.t0 is None:
+            self.t0 = pts
+        sec = int(pts - self.t0) if pts > self.t0 else 0
+        if sec < self.next_sec:
+            # it comes after the second was closed.
+            self.nb_late += 1
+            sec = self.next_sec
+        self.open_secs[sec] = self.open_secs.get(sec, 0) + size*8
+        if pts > self.max_pts:
+            self.max_pts = pts
+            self._close_seconds(sec - self.reorder)
+
+    def _close_gop(self, pts):
+        duration = pts - self.gop_pts
+        self.gop_size.add(self.gop_nb_bytes)
+        self.gop_length.add(self.gop_frames)
+        self.hist_frames[self.gop_frames] = self.hist_frames.get(
+                self.gop_frames, 0) + 1
+        if not math.isnan(duration):
+            self.gop_duration.add(duration)
+            k = round(duration, 2)
+            self.hist_duration[k] = self.hist_duration.get(k, 0) + 1
+        if self.on_gop is not None:
+            self.on_gop(self.gop_pts, duration, self.gop_frames,
+                        self.gop_nb_bytes)
+
+    def _close_seconds(self, last, partial=False):
+        """
+        close the seconds until last.
+        """
+        while self.next_sec <= last:
+            sec = self.next_sec
+            bits = self.open_secs.pop(sec, 0)
+            self.next_sec += 1
+            if self.on_second is not None:
+                self.on_second(sec, bits)
+            if partial and sec == last:
+                # the last second of the file is not counted.
+                break
+            self.bitrate.add(bits)
+            for w,x in self.peaks.items():
+                window = x[0]
+                if len(window) == w:
+                    x[1] -= window[0]
+                window.append(bits)
+                x[1] += bits
+                if len(window) == w and x[1] > x[2]:
+                    x[2] = x[1]
+                    x[3] = sec - w + 1
+
+    def finish(self):
+        if self.open_secs:
+            self._close_seconds(max(self.open_secs), partial=True)
+
+    def peak_bitrates(self):
+        """
+        return a dict of the width of the window: (bps, start second).
+        """
+        return { w: (x[2]/w, x[3]) for w,x in self.peaks.items()
+                 if x[3] is not None }
+
+    def to_dict(self):
+        return {
+                "nb_frames": self.nb_frames,
+                "nb_bytes": self.nb_bytes,
+                "nb_keys": self.nb_keys,
+                "nb_late": self.nb_late,
+                "duration": (self.max_pts - self.t0
+                             if self.t0 is not None else None),
+                "gop_duration": self.gop_duration.to_dict(),
+                "gop_bytes": self.gop_size.to_dict(),
+                "gop_frames": self.gop_length.to_dict(),
+                "bitrate": self.bitrate.to_dict(),
+                "peak_bitrate": [ {"window": w, "bps": b, "start": t}
+                                  for w,(b,t) in
+                                  self.peak_bitrates().items() ],
+                "hist_gop_frames": sorted(self.hist_frames.items()),
+                "hist_gop_duration": sorted(self.hist_duration.items()),
+                }
@@ -2,10 +2,197 @@ import sys
 from subprocess import Popen, PIPE, DEVNULL
 import shlex
 import math
+import re
 import json
 from datetime import timedelta
 from shutil import get_terminal_size
 import os
+import time
+import atexit
+import threading
+import hashlib
+import mmap
+from collections import OrderedDict
+from itertools import islice
+from tempfile import TemporaryFile
+from contextlib import contextmanager
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                        os.path.expanduser("~/.cache")),
+                         "fftools")
+
+READ_CHUNK_SIZE = 1<<16
+
+SOCKET_PATH = os.environ.get("FFTOOLS_SOCKET",
+                             os.path.join(CACHE_DIR, "probe.sock"))
+# seconds to wait for the probe service before falling back.
+SOCKET_TIMEOUT = 30.
+
+_probe_cache = None
+_probe_native = False
+_probe_remote = False
+_probe_refresh = False
+
+def _cpu_times():
+    """
+    return the CPU time of this process and of the children waited.
+    """
+    t = os.times()
+    return t.user + t.system, t.children_user + t.children_system
+
+class Metrics():
+
+    def __init__(self):
+        """
+        the wall and CPU time of each phase, the subprocesses spawned,
+        and the counters, e.g. the bytes read from the pipes.
+        CPU time is of the whole process, so it includes the other threads
+        running at the same time.  the phases can be nested.
+        """
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        # name: [calls, wall, cpu, children cpu]
+        self.phases = {}
+        # program: [spawns, seconds, max seconds]
+        self.spawns = {}
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        c0, cc0 = _cpu_times()
+        try:
+            yield
+        finally:
+            c1, cc1 = _cpu_times()
+            self.add_phase(name, time.perf_counter() - t0, c1 - c0,
+                           cc1 - cc0)
+
+    def add_phase(self, name, wall, cpu=0., children_cpu=0.):
+        with self.lock:
+            x = self.phases.setdefault(name, [0, 0., 0., 0.])
+            x[0] += 1
+            x[1] += wall
+            x[2] += cpu
+            x[3] += children_cpu
+
+    def add_spawn(self, program, seconds):
+        with self.lock:
+            x = self.spawns.setdefault(program, [0, 0., 0.])
+            x[0] += 1
+            x[1] += seconds
+            x[2] = max(x[2], seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def print_summary(self, file=sys.stderr):
+        cpu, children_cpu = _cpu_times()
+        print("## total: wall {:.3f}s cpu {:.3f}s children cpu {:.3f}s"
+              .format(time.perf_counter() - self.t0, cpu, children_cpu),
+              file=file)
+        if self.phases:
+            print("{:16} {:>8} {:>10} {:>10} {:>10}".format(
+                    "Phase", "Calls", "Wall", "CPU", "Child CPU"), file=file)
+            for k,v in sorted(self.phases.items(), key=lambda x: -x[1][1]):
+                print("{:16} {:8} {:10.3f} {:10.3f} {:10.3f}".format(
+                        k, *v), file=file)
+        if self.spawns:
+            print("{:16} {:>8} {:>10} {:>10}".format(
+                    "Subprocess", "Spawns", "Seconds", "Max"), file=file)
+            for k,v in sorted(self.spawns.items()):
+                print("{:16} {:8} {:10.3f} {:10.3f}".format(k, *v),
+                      file=file)
+        for k,v in sorted(self.counters.items()):
+            print(f"{k}: {v}", file=file)
+
+    def write_textfile(self, path, tool):
+        """
+        write the metrics in the Prometheus text format, e.g. for
+        the textfile collector of node_exporter.  the file is replaced
+        atomically.
+        """
+        cpu, children_cpu = _cpu_times()
+        lines = []
+        def add(name, kind, help_text, samples):
+            lines.append(f"# HELP fftools_{name} {help_text}")
+            lines.append(f"# TYPE fftools_{name} {kind}")
+            for labels,v in samples:
+                labels = ",".join([f'{k}="{v}"' for k,v in
+                                   [("tool", tool), *labels]])
+                lines.append(f"fftools_{name}{{{labels}}} {v}")
+        add("run_seconds", "gauge", "wall time of the run.",
+            [([], time.perf_counter() - self.t0)])
+        add("cpu_seconds", "gauge", "CPU time of the run.",
+            [([("process", "self")], cpu),
+             ([("process", "children")], children_cpu)])
+        add("phase_calls_total", "counter", "number of the phases.",
+            [([("phase", k)], v[0]) for k,v in self.phases.items()])
+        add("phase_seconds_total", "counter", "time spent in the phases.",
+            [([("phase", k), ("clock", c)], v[i])
+             for k,v in self.phases.items()
+             for i,c in [(1, "wall"), (2, "cpu"), (3, "children_cpu")]])
+        add("subprocess_spawns_total", "counter",
+            "number of the subprocesses spawned.",
+            [([("program", k)], v[0]) for k,v in self.spawns.items()])
+        add("subprocess_seconds_total", "counter",
+            "lifetime of the subprocesses.",
+            [([("program", k)], v[1]) for k,v in self.spawns.items()])
+        for k,v in sorted(self.counters.items()):
+            add(f"{k}_total", "counter", f"number of {k}.", [([], v)])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fd:
+            fd.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+metrics = Metrics()
+
+class Process(Popen):
+
+    def __init__(self, args, **kwargs):
+        """
+        Popen recording the spawn and its lifetime into metrics.
+        the lifetime is recorded when the process is waited.
+        """
+        self._t0 = time.perf_counter()
+        self._recorded = False
+        super().__init__(args, **kwargs)
+
+    def wait(self, timeout=None):
+        ret = super().wait(timeout=timeout)
+        if not self._recorded:
+            self._recorded = True
+            program = self.args[0] if isinstance(self.args, list) else (
+                    shlex.split(self.args)[0])
+            metrics.add_spawn(os.path.basename(program),
+                              time.perf_counter() - self._t0)
+        return ret
+
+def add_metrics_arguments(ap):
+    ap.add_argument("--perf", action="store_true", dest="show_perf",
+                    help="show the time spent in each phase and "
+                    "the subprocesses to stderr at the end.")
+    ap.add_argument("--metrics", action="store", dest="metrics_file",
+                    help="specify a file to write the metrics in "
+                    "the Prometheus text format at the end.")
+
+def setup_metrics(opt):
+    """
+    opt: the result of ArgumentParser.parse_args() in which
+    add_metrics_arguments() has been applied.
+    """
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    def report():
+        if opt.show_perf:
+            metrics.print_summary()
+        if opt.metrics_file:
+            try:
+                metrics.write_textfile(opt.metrics_file, tool)
+            except OSError as e:
+                print(f"WARNING: {e}", file=sys.stderr)
+    if opt.show_perf or opt.metrics_file:
+        atexit.register(report)
 
 class ffPrintInfo():
 
@@ -48,6 +235,9 @@ class ffPrintInfo():
         self.hdr_sep = " ".join([ "-"*len(i) for i in self.hdrs.values() ])
         self.left_cols_len = (len(self.hdr_sep) -
                               len(self.hdrs["fixed_filename"]) - 1)
+        # get the terminal size once, not for every row.
+        self.name_len = (get_terminal_size((80,0)).columns -
+                         self.left_cols_len - 1)
 
     def print_header(self):
         print(self.header_format.format(*self.hdrs.values()))
@@ -62,9 +252,7 @@ class ffPrintInfo():
             if self.print_mode == 2:
                 return path
             else:
-                name_len = (get_terminal_size((80,0)).columns -
-                            self.left_cols_len - 1)
-                return os.path.basename(path)[:name_len]
+                return os.path.basename(path)[:self.name_len]
         def str_duration(duration):
             str_dur = str(timedelta(seconds=duration)).rjust(15,"0")
             if self.print_mode == 2:
@@ -80,8 +268,9 @@ class ffPrintInfo():
         ffinfo["str_bit_rate"] = str_bitrate(ffinfo["bit_rate"])
         ffinfo["str_duration"] = str_duration(ffinfo["duration"])
         ffinfo["fixed_filename"] = fix_filename(ffinfo["path"])
-        print(self.header_format.format(
-                *[ffinfo[k] for k in self.hdrs.keys()]))
+        with metrics.phase("output"):
+            print(self.header_format.format(
+                    *[ffinfo[k] for k in self.hdrs.keys()]))
 
 def get_duration(ffinfo):
     """
@@ -108,6 +297,74 @@ def get_stream_info(input_file, codec_type=None, verbose=False):
     """
     codec_type: video, audio, or None
     """
+    steps = stream_info_steps(input_file, codec_type=codec_type,
+                              verbose=verbose)
+    result = None
+    try:
+        while True:
+            phase, func, kwargs = steps.send(result)
+            with metrics.phase(phase):
+                result = func(**kwargs)
+    except StopIteration as e:
+        return e.value
+
+def stream_info_steps(input_file, codec_type=None, verbose=False):
+    """
+    the lookups of get_stream_info() in order, shared with
+    async_get_stream_info() in ffasync.py.
+    it yields (phase, func, kwargs) of each lookup, and the caller sends
+    the result of func(**kwargs) back.  the streams are returned at the end.
+    """
+    metrics.count("files")
+    if _probe_native and codec_type == "video":
+        ffinfo = yield ("probe_native", native_stream_info,
+                        {"input_file": input_file, "codec_type": codec_type,
+                         "verbose": verbose})
+        if ffinfo is not None:
+            return ffinfo
+    ff_result = None
+    if _probe_remote:
+        refresh = _probe_refresh or (_probe_cache is not None and
+                                     _probe_cache.refresh)
+        ff_result = yield ("probe_remote", probe_remote,
+                           {"input_file": input_file, "refresh": refresh})
+    if ff_result is None and _probe_cache is not None:
+        ff_result = yield ("probe_cache", _probe_cache.get,
+                           {"input_file": input_file})
+        if ff_result is not None:
+            metrics.count("probe_cache_hits")
+    if ff_result is None:
+        ff_result = yield ("ffprobe", probe_streams,
+                           {"input_file": input_file, "verbose": verbose})
+        if _probe_cache is not None:
+            yield ("probe_cache", _probe_cache.put,
+                   {"input_file": input_file, "result": ff_result})
+    with metrics.phase("json"):
+        ffinfo = json.loads(ff_result)
+    return make_stream_info(input_file, ffinfo, codec_type=codec_type,
+                            verbose=verbose)
+
+def native_stream_info(input_file, codec_type=None, verbose=False):
+    """
+    return the streams parsed by ffnative.py, or None if it can't.
+    """
+    import ffnative
+    try:
+        ffinfo = ffnative.probe(input_file)
+        return make_stream_info(input_file, ffinfo, codec_type=codec_type,
+                                verbose=verbose)
+    except Exception as e:
+        # fall back to ffprobe.
+        if verbose:
+            print(f"NATIVE: {input_file}: {e}")
+        return None
+
+def make_stream_info(input_file, ffinfo, codec_type=None, verbose=False):
+    """
+    return the list of the streams in ffinfo, the result of
+    ffprobe -show_streams, with the parameters fixed.
+    see get_stream_info() about codec_type.
+    """
     #
     # functions to fix some parameters
     #
@@ -139,27 +396,18 @@ def get_stream_info(input_file, codec_type=None, verbose=False):
             try:
                 a = float(str_fps)
             except ValueError:
-                print(f"ERROR: {str_fps} is not a float.", file=strerr)
+                print(f"ERROR: {str_fps} is not a float.", file=sys.stderr)
                 return 0.
             else:
                 return round(a)
     #
     # END: functions to fix some parameters
     #
-    cmd = f"ffprobe -i {shlex.quote(input_file)} -v error -show_streams -of json"
-    if verbose:
-        print("COMMAND:", cmd)
-    p = Popen(shlex.split(cmd), stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
-            universal_newlines=True)
-    ff_result, err = p.communicate()
-    if err:
-        raise ValueError("ERROR:", err)
-    ffinfo = json.loads(ff_result)
     if verbose:
         print("\n".join([ "{}={}".format(*a) for a in ffinfo.items() ]))
+    ffinfo = ffinfo.get("streams", [])
     if codec_type is not None:
-        ffinfo = [ x for x in ffinfo["streams"]
-                   if x["codec_type"] == codec_type ]
+        ffinfo = [ x for x in ffinfo if x["codec_type"] == codec_type ]
     if len(ffinfo) == 0:
         print("ERROR: no stream info")
     # put input_file into "path" in each dict.
@@ -179,6 +427,426 @@ def get_stream_info(input_file, codec_type=None, verbose=False):
     #
     return ffinfo
 
+def probe_streams_command(input_file):
+    return f"ffprobe -i {shlex.quote(input_file)} -v error -show_streams -of json"
+
+def probe_streams(input_file, verbose=False):
+    """
+    return the output of ffprobe -show_streams in json text.
+    """
+    cmd = probe_streams_command(input_file)
+    if verbose:
+        print("COMMAND:", cmd)
+    p = Process(shlex.split(cmd), stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+            universal_newlines=True)
+    ff_result, err = p.communicate()
+    metrics.count("pipe_bytes", len(ff_result))
+    if err:
+        raise ValueError(err.strip())
+    return ff_result
+
+class ProbeCache():
+
+    def __init__(self, db_file=None, lru_size=4096, max_entries=200000,
+                 refresh=False, verbose=False):
+        """
+        cache of the output of probe_streams().
+        an entry is valid while the path, size, mtime and inode of the
+        file are not changed.  it consists of an in-process LRU and
+        a sqlite database.  the least recently used entries in the
+        database are evicted when it has more than max_entries at close().
+        refresh: ignore the entries cached, but store new results.
+        db_file: None means the default, "" means no database.
+        """
+        # imported here not to slow down the tools without the cache.
+        import sqlite3
+        self.lru_size = lru_size
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.verbose = verbose
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.touched = {}
+        self.db = None
+        if db_file is None:
+            db_file = os.path.join(CACHE_DIR, "probe.sqlite3")
+        if db_file:
+            try:
+                os.makedirs(os.path.dirname(db_file), exist_ok=True)
+                self.db = sqlite3.connect(db_file, check_same_thread=False)
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute("PRAGMA synchronous=NORMAL")
+                self.db.execute("""
+                        CREATE TABLE IF NOT EXISTS probe (
+                        path TEXT PRIMARY KEY, size INTEGER,
+                        mtime_ns INTEGER, ino INTEGER,
+                        atime REAL, result TEXT)""")
+                self.db.execute("""
+                        CREATE INDEX IF NOT EXISTS probe_atime
+                        ON probe (atime)""")
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"WARNING: cache {db_file} is not available. {e}",
+                      file=sys.stderr)
+                self.db = None
+        atexit.register(self.close)
+
+    def _key(self, input_file):
+        st = os.stat(input_file)
+        return (os.path.abspath(input_file), st.st_size, st.st_mtime_ns,
+                st.st_ino)
+
+    def get(self, input_file):
+        """
+        return the result cached, or None.
+        """
+        if self.refresh:
+            return None
+        try:
+            key = self._key(input_file)
+        except OSError:
+            return None
+        with self.lock:
+            result = self.lru.get(key)
+            if result is not None:
+                self.lru.move_to_end(key)
+                self.touched[key[0]] = time.time()
+                if self.verbose:
+                    print(f"CACHE: {input_file}")
+                return result
+            if self.db is None:
+                return None
+            row = self.db.execute(
+                    "SELECT size, mtime_ns, ino, result FROM probe "
+                    "WHERE path = ?", (key[0],)).fetchone()
+            if row is None or tuple(row[:3]) != key[1:]:
+                return None
+            self.touched[key[0]] = time.time()
+            self._lru_put(key, row[3])
+            if self.verbose:
+                print(f"CACHE: {input_file}")
+            return row[3]
+
+    def put(self, input_file, result):
+        try:
+            key = self._key(input_file)
+        except OSError:
+            return
+        with self.lock:
+            self._lru_put(key, result)
+            if self.db is None:
+                return
+            # commit it at once not to lock the database for a long time.
+            # it is cheap in WAL mode with synchronous=NORMAL.
+            self.db.execute(
+                    "INSERT OR REPLACE INTO probe VALUES (?,?,?,?,?,?)",
+                    (*key, time.time(), result))
+            self.db.commit()
+
+    def _lru_put(self, key, result):
+        self.lru[key] = result
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def close(self):
+        import sqlite3
+        with self.lock:
+            if self.db is None:
+                return
+            try:
+                if self.touched:
+                    self.db.executemany(
+                            "UPDATE probe SET atime = ? WHERE path = ?",
+                            [(v,k) for k,v in self.touched.items()])
+                # evict the least recently used entries.
+                self.db.execute("""
+                        DELETE FROM probe WHERE path IN (
+                        SELECT path FROM probe ORDER BY atime DESC
+                        LIMIT -1 OFFSET ?)""", (self.max_entries,))
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"WARNING: cache is not updated. {e}", file=sys.stderr)
+            self.db.close()
+            self.db = None
+
+def set_probe_cache(cache):
+    """
+    cache: an instance of ProbeCache, or None to disable the cache.
+    """
+    global _probe_cache
+    _probe_cache = cache
+
+def request_remote(req):
+    """
+    return the response of the probe service to req, see ffserver.py.
+    return None if the service is not running or doesn't answer
+    in SOCKET_TIMEOUT seconds.
+    """
+    if not os.path.exists(SOCKET_PATH):
+        return None
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(SOCKET_TIMEOUT)
+            s.connect(SOCKET_PATH)
+            s.sendall(json.dumps(req).encode() + b"\n")
+            with s.makefile("rb") as fd:
+                line = fd.readline()
+            metrics.count("socket_bytes", len(line))
+            return json.loads(line)
+    except (OSError, ValueError):
+        return None
+
+def probe_remote(input_file, refresh=False):
+    """
+    return the output of probe_streams() from the probe service.
+    return None if the service is not running.
+    once the service is found not running, it is not tried again.
+    """
+    return remote_probe_result(request_remote(
+            remote_probe_request(input_file, refresh=refresh)))
+
+def remote_probe_request(input_file, refresh=False):
+    return {
+            "op": "probe",
+            "path": os.path.abspath(input_file),
+            "refresh": refresh,
+            }
+
+def remote_probe_result(res):
+    """
+    return the output of probe_streams() in res, the response of the probe
+    service.  None means the service didn't answer, and it is not tried
+    again after that.
+    """
+    global _probe_remote
+    if res is None:
+        _probe_remote = False
+        return None
+    if "error" in res:
+        raise ValueError(res["error"])
+    return res["result"]
+
+def set_probe_remote(remote, refresh=False):
+    """
+    remote: if True, get_stream_info() asks the probe service if running.
+    refresh: ask the service to probe files again.
+    """
+    global _probe_remote, _probe_refresh
+    _probe_remote = remote
+    _probe_refresh = refresh
+
+def set_probe_native(native):
+    """
+    native: if True, get_stream_info() parses the header of MP4 and
+    Matroska files by itself for the video streams, and uses ffprobe
+    only for the other containers.
+    """
+    global _probe_native
+    _probe_native = native
+
+def add_probe_arguments(ap):
+    ap.add_argument("--no-cache", action="store_false", dest="use_cache",
+                    help="disable the probe cache.")
+    ap.add_argument("--refresh", action="store_true", dest="refresh_cache",
+                    help="probe files again and update the probe cache.")
+    ap.add_argument("--native", action="store_true", dest="probe_native",
+                    help="parse the header of MP4 and Matroska files "
+                    "without ffprobe.")
+    ap.add_argument("--no-daemon", action="store_false", dest="use_daemon",
+                    help="don't use the probe service even if running.")
+    add_metrics_arguments(ap)
+
+def setup_probe(opt):
+    """
+    opt: the result of ArgumentParser.parse_args() in which
+    add_probe_arguments() has been applied.
+    """
+    set_probe_native(opt.probe_native)
+    # the service has the cache.  the local one is not opened if it answers.
+    # if it stops later, the files are probed by ffprobe without the cache.
+    remote = (opt.use_cache and opt.use_daemon and
+              request_remote({"op": "ping"}) is not None)
+    set_probe_remote(remote, refresh=opt.refresh_cache)
+    if opt.use_cache and not remote:
+        set_probe_cache(ProbeCache(refresh=opt.refresh_cache,
+                                   verbose=opt.verbose))
+    else:
+        set_probe_cache(None)
+    setup_metrics(opt)
+
+def partial_hash(path, nb_chunks=3, chunk_size=1<<16):
+    """
+    return a hash of the size and nb_chunks of chunk_size bytes evenly
+    spaced in the file, including the head and the tail.
+    only a small part of the file is read through mmap.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        h.update(str(size).encode())
+        if size == 0:
+            return h.hexdigest()
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if size <= nb_chunks*chunk_size:
+                h.update(m[:])
+            else:
+                step = (size - chunk_size) // (nb_chunks - 1)
+                for i in range(nb_chunks):
+                    h.update(m[i*step:i*step+chunk_size])
+    metrics.count("hash_bytes", min(size, nb_chunks*chunk_size))
+    return h.hexdigest()
+
+def full_hash(path, chunk_size=1<<20):
+    """
+    return a hash of the whole file read through mmap.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for i in range(0, size, chunk_size):
+                    h.update(m[i:i+chunk_size])
+    metrics.count("hash_bytes", size)
+    return h.hexdigest()
+
+def keyframe_fingerprint(input_file, duration, nb_windows=3, nb_packets=30,
+                         verbose=False):
+    """
+    return a hash of the sizes of nb_packets video packets from the key
+    frame at nb_windows points evenly spaced in the duration.
+    the packets are not changed by remuxing, so the files of the same
+    video in the different containers have the same fingerprint.
+    only the packets in the windows are read.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for i in range(nb_windows):
+        t = duration*(i+1)/(nb_windows+1)
+        packets = iter_packets(input_file, entries=["size", "flags"],
+                               read_intervals=f"{t:.3f}%+10",
+                               verbose=verbose)
+        try:
+            sizes = []
+            for x in packets:
+                if not sizes and not x.get("flags", "").startswith("K"):
+                    continue
+                sizes.append(x.get("size", "0"))
+                if len(sizes) == nb_packets:
+                    break
+        finally:
+            packets.close()
+        h.update((",".join(sizes) + ";").encode())
+    return h.hexdigest()
+
+class Manifest():
+
+    def __init__(self, path):
+        """
+        manifest of the conversions, in JSON lines.  the last record
+        of each input file is effective.  it is thread safe.
+        a record has:
+            input, output: absolute path.
+            size, mtime_ns, hash: identity of the input file.
+            options: the options of the conversion.
+            status: "running", "done" or "failed".
+            output_existed: True if the output had existed before the
+                conversion, and was not left by this tool.
+            output_size: the size of the output when it is done.
+        """
+        self.records = {}
+        broken = False
+        if os.path.exists(path):
+            with open(path) as fd:
+                for line in fd:
+                    broken = not line.endswith("\n")
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # a line broken by an interruption.
+                        continue
+                    self.records[rec["input"]] = rec
+        self.fd = open(path, "a")
+        if broken:
+            # not to glue the next record onto the broken line.
+            self.fd.write("\n")
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _write(self, rec):
+        with self.lock:
+            self.records[rec["input"]] = rec
+            if not self.fd.closed:
+                self.fd.write(json.dumps(rec) + "\n")
+                self.fd.flush()
+
+    def _same_input(self, rec, input_file):
+        st = os.stat(input_file)
+        if st.st_size != rec["size"]:
+            return False
+        if st.st_mtime_ns == rec["mtime_ns"]:
+            return True
+        # e.g. copied with a new mtime.
+        return partial_hash(input_file) == rec["hash"]
+
+    def is_done(self, input_file, output_file, options):
+        """
+        return True if the input_file has been converted into the
+        output_file with the options, and the output is complete.
+        """
+        rec = self.records.get(os.path.abspath(input_file))
+        if (rec is None or rec["status"] != "done" or
+            rec["output"] != os.path.abspath(output_file) or
+            rec["options"] != options):
+            return False
+        try:
+            return (os.stat(output_file).st_size == rec["output_size"] and
+                    self._same_input(rec, input_file))
+        except OSError:
+            return False
+
+    def is_partial(self, input_file, output_file):
+        """
+        return True if the output_file was left by a conversion
+        which didn't complete.  a file which had existed before the
+        conversion is not partial, e.g. ffmpeg refused to overwrite it.
+        """
+        rec = self.records.get(os.path.abspath(input_file))
+        return (rec is not None and rec["status"] != "done" and
+                not rec.get("output_existed", True) and
+                rec["output"] == os.path.abspath(output_file) and
+                os.path.exists(output_file))
+
+    def start(self, input_file, output_file, options):
+        st = os.stat(input_file)
+        # a partial output left by this tool is still owned by it.
+        existed = (os.path.exists(output_file) and
+                   not self.is_partial(input_file, output_file))
+        self._write({
+                "input": os.path.abspath(input_file),
+                "output": os.path.abspath(output_file),
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "hash": partial_hash(input_file),
+                "options": options,
+                "status": "running",
+                "output_existed": existed,
+                "ts": time.time(),
+                })
+
+    def finish(self, input_file, result):
+        rec = dict(self.records[os.path.abspath(input_file)])
+        rec["status"] = "done" if result else "failed"
+        rec["ts"] = time.time()
+        if result:
+            rec["output_size"] = os.stat(rec["output"]).st_size
+        self._write(rec)
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
 def get_aspect_ratio(ffinfo):
     ar = ffinfo.get("display_aspect_ratio")
     if ar is None:
@@ -187,7 +855,111 @@ def get_aspect_ratio(ffinfo):
         ar = ":".join([str(int(i/math.gcd(w, h))) for i in [w,h]])
     return ar
 
-def get_frames(input_file, max_frames=0, entries=[], verbose=False):
+def iter_records(cmd, section, verbose=False):
+    """
+    run the ffprobe command in cmd with "-of compact", and yield a dict
+    for each line of the section, e.g. "frame" or "packet".
+    the stdout is read in large chunks.  ffprobe is killed as soon as
+    the generator is closed, e.g. the consumer breaks the loop.
+    """
+    if verbose:
+        print("CMD==>", cmd)
+    head = f"{section}|".encode()
+    head_len = len(head)
+    # stderr goes into a file so that ffprobe is never blocked by it.
+    errfd = TemporaryFile()
+    p = Process(shlex.split(cmd), stdin=DEVNULL, stdout=PIPE, stderr=errfd)
+    # counted locally, and put into metrics at the end.
+    nb_bytes = 0
+    nb_records = 0
+    t_read = 0.
+    try:
+        rest = b""
+        while True:
+            t0 = time.perf_counter()
+            buf = p.stdout.read1(READ_CHUNK_SIZE)
+            t_read += time.perf_counter() - t0
+            if not buf:
+                break
+            nb_bytes += len(buf)
+            lines = (rest + buf).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                if verbose:
+                    print("COL:", line.decode(errors="replace"))
+                if not line.startswith(head):
+                    # it's not a record, just to be ignored.
+                    continue
+                nb_records += 1
+                yield dict(x.split("=", 1) for x in
+                           line[head_len:].decode().rstrip("\r").split("|"))
+        if p.wait():
+            errfd.seek(0)
+            print(f"ERROR: {errfd.read().decode(errors='replace').strip()}")
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        p.stdout.close()
+        errfd.close()
+        metrics.add_phase(f"{section}_read", t_read)
+        metrics.count("pipe_bytes", nb_bytes)
+        metrics.count(f"{section}s", nb_records)
+
+def records_command(input_file, section, entries=[], read_intervals=None):
+    """
+    return the ffprobe command for iter_records().
+    section: "frame" of the video streams, or "packet" of the first one.
+    """
+    streams = "v" if section == "frame" else "v:0"
+    opts = [f"-v error -of compact -select_streams {streams} -show_{section}s"]
+    if entries:
+        opts.append("-show_entries {}={}".format(section, ",".join(entries)))
+    if read_intervals:
+        opts.append(f"-read_intervals {shlex.quote(read_intervals)}")
+    opts.append(f"-i {shlex.quote(input_file)}")
+    return "ffprobe {}".format(" ".join(opts))
+
+def iter_frames(input_file, entries=[], read_intervals=None, verbose=False):
+    """
+    yield a dict of each video frame in the input_file.
+    see get_frames() about entries, and iter_packets() about read_intervals.
+    """
+    cmd = records_command(input_file, "frame", entries=entries,
+                          read_intervals=read_intervals)
+    return iter_records(cmd, "frame", verbose=verbose)
+
+def iter_packets(input_file, entries=[], read_intervals=None, verbose=False):
+    """
+    yield a dict of each packet of the first video stream in the input_file.
+    it doesn't decode any frame, so it is much faster than iter_frames().
+    entries:
+        "codec_type", "stream_index", "pts", "pts_time", "dts",
+        "dts_time", "duration", "duration_time", "size", "pos", "flags",
+    flags: "K" at the top means a key frame.
+    read_intervals: passed to the -read_intervals option of ffprobe.
+        e.g. "600%+30" reads 30 seconds from the key frame before 600 sec.
+    """
+    cmd = records_command(input_file, "packet", entries=entries,
+                          read_intervals=read_intervals)
+    return iter_records(cmd, "packet", verbose=verbose)
+
+def get_packets(input_file, max_packets=0, entries=[], read_intervals=None,
+                verbose=False):
+    """
+    see iter_packets() about entries and read_intervals.
+    """
+    packets = iter_packets(input_file, entries=entries,
+                           read_intervals=read_intervals, verbose=verbose)
+    try:
+        if max_packets:
+            return list(islice(packets, max_packets))
+        return list(packets)
+    finally:
+        packets.close()
+
+def get_frames(input_file, max_frames=0, entries=[], read_intervals=None,
+               verbose=False):
     """
     entries:
         "media_type", "stream_index", "key_frame",
@@ -199,61 +971,246 @@ def get_frames(input_file, max_frames=0, entries=[], verbose=False):
         "display_picture_number", "interlaced_frame", "top_field_first",
         "repeat_pict", "color_range", "color_space", "color_primaries",
         "color_transfer", "chroma_location",
+    read_intervals: see iter_packets().
     """
-    opts = ["-v error -of compact -select_streams v -show_frames"]
-    if entries:
-        opts.append("-show_entries frame={}".format(",".join(entries)))
-    opts.append(f"-i {shlex.quote(input_file)}")
-    cmd = "ffprobe {}".format(" ".join(opts))
-    if verbose:
-        print("CMD==>", cmd)
-    #
-    frames = []
-    p = Popen(shlex.split(cmd), stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
-              universal_newlines=True)
-    nb_lines = 1
-    while p.poll() is None:
-        cols = p.stdout.readline().strip().split("|")
-        if verbose:
-            print("COL:", cols)
-        if cols[0] != "frame":
-            # it's not a frame info, just to be ignored.
-            continue
-        frames.append(dict(x.split("=") for x in cols[1:]))
-        # another condition to break
-        nb_lines += 1
-        if max_frames and nb_lines > max_frames:
-            break
+    frames = iter_frames(input_file, entries=entries,
+                         read_intervals=read_intervals, verbose=verbose)
+    try:
+        if max_frames:
+            return list(islice(frames, max_frames))
+        return list(frames)
+    finally:
+        frames.close()
 
-    if p.poll():
-        print(f"ERROR: {p.stderr.read()}")
+def measure_quality(input_file, reference_file, input_opts="",
+                    reference_opts="", reference_vf=None, verbose=False):
+    """
+    return a dict of "ssim" (All) and "psnr" (average in dB) of the video
+    in the input_file against the reference_file.
+    input_opts, reference_opts: the input options of ffmpeg for each,
+        e.g. "-ss 60 -t 10" to compare a part of them.
+    reference_vf: the filters applied to the reference in advance to
+        match the input, e.g. "scale=1280:-2,transpose=1".
+    the input is scaled to the size of the reference after that, and
+    the timestamps of both start from zero.
+    """
+    ref_vf = f"{reference_vf}," if reference_vf else ""
+    lavfi = (f"[0:v]setpts=PTS-STARTPTS[d0];"
+             f"[1:v]{ref_vf}setpts=PTS-STARTPTS[r0];"
+             "[d0][r0]scale2ref=flags=bicubic[d][r];"
+             "[d]split[d1][d2];[r]split[r1][r2];"
+             "[d1][r1]ssim;[d2][r2]psnr")
+    cmd = ("ffmpeg -nostats -hide_banner "
+           f"{input_opts + ' ' if input_opts else ''}"
+           f"-i {shlex.quote(input_file)} "
+           f"{reference_opts + ' ' if reference_opts else ''}"
+           f"-i {shlex.quote(reference_file)} "
+           f"-lavfi {shlex.quote(lavfi)} -an -f null -")
+    if verbose:
+        print("COMMAND:", cmd)
+    p = Process(shlex.split(cmd), stdin=DEVNULL, stdout=DEVNULL,
+                stderr=PIPE, universal_newlines=True)
+    err = p.communicate()[1]
+    if p.returncode != 0:
+        raise ValueError(err.strip().split("\n")[-1])
+    result = {}
+    m = re.search(r"SSIM .*All:([0-9.]+)", err)
+    if m:
+        result["ssim"] = float(m.group(1))
+    m = re.search(r"PSNR .*average:([0-9.]+|inf)", err)
+    if m:
+        result["psnr"] = float(m.group(1))
+    if not result:
+        raise ValueError("no SSIM nor PSNR in the output of ffmpeg.")
+    return result
 
-    return frames
+def make_contact_sheet(input_file, duration, cols=4, rows=4, width=320,
+                       cache_dir=None, verbose=False):
+    """
+    return the path of a JPEG of cols x rows thumbnails of the key frames
+    evenly spaced in the duration.  only the key frames are decoded, and
+    the sheet is made in a single ffmpeg run.
+    the sheet is cached by the path, size, mtime and inode of the file.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(CACHE_DIR, "thumbs")
+    st = os.stat(input_file)
+    key = hashlib.blake2b("|".join([str(x) for x in [
+            os.path.abspath(input_file), st.st_size, st.st_mtime_ns,
+            st.st_ino, cols, rows, width]]).encode(),
+            digest_size=16).hexdigest()
+    output_file = os.path.join(cache_dir, f"{key}.jpg")
+    if os.path.exists(output_file):
+        metrics.count("thumb_cache_hits")
+        return output_file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = os.path.join(
+            cache_dir, f".{key}.{os.getpid()}.{threading.get_ident()}.jpg")
+    interval = duration / (cols*rows)
+    vf = (f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,"
+          f"{interval:.3f})',scale={width}:-2,tile={cols}x{rows}")
+    cmd = (f"ffmpeg -v error -y -skip_frame nokey -i {shlex.quote(input_file)} "
+           f"-an -vf {shlex.quote(vf)} -vsync vfr -frames:v 1 "
+           f"{shlex.quote(tmp_file)}")
+    if verbose:
+        print("COMMAND:", cmd)
+    p = Process(shlex.split(cmd), stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE,
+                universal_newlines=True)
+    err = p.communicate()[1]
+    if p.returncode != 0 or not os.path.exists(tmp_file):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise ValueError(err.strip() or "no thumbnail is made.")
+    os.replace(tmp_file, output_file)
+    return output_file
 
 def parse_time(src):
     """
     convert time-like string into a float number in second.
     return the number.
+    the syntax is of the duration of ffmpeg, i.e. [[HH:]MM:]SS[.m...],
+    so "100" is 100 seconds as ffmpeg takes it.
     """
-    if src.find(".") > 0:
-        s_hms, s_dec = src.split(".")
-        n_dec = float(f".{s_dec.ljust(6,'0')}")
-    else:
-        s_hms = src
-        n_dec = 0.
-    s = s_hms.replace(":","").rjust(6,"0")
-    return sum([a*b for a,b in zip(
-            [int(s[i:i+2]) for i in range(0,6,2)],
-            [3600,60,1])]) + n_dec
-
-def progress_bar(a, b, width=70):
+    return sum([float(a)*b for a,b in zip(reversed(src.split(":")),
+                                          [1,60,3600])])
+
+def iter_progress(fd):
+    """
+    yield a dict of each report of "ffmpeg -progress pipe:1".
+    fd: the stdout of ffmpeg in text mode.
+    the values are converted into numbers, None if not available:
+        time: the time of the output in seconds.
+        frame, fps, dup_frames, drop_frames, total_size (bytes),
+        bitrate (kbps), speed (ratio to realtime).
+    "progress" is "continue" or "end".
+    """
+    def to_number(v, conv=float):
+        try:
+            return conv(v)
+        except (TypeError, ValueError):
+            return None
+    #
+    block = {}
+    for line in fd:
+        metrics.count("pipe_bytes", len(line))
+        k, sep, v = line.strip().partition("=")
+        if not sep:
+            continue
+        block[k] = v
+        if k != "progress":
+            continue
+        # out_time_ms is also in microseconds.
+        us = to_number(block.get("out_time_us", block.get("out_time_ms")),
+                       int)
+        info = {
+                "time": us/1000000 if us is not None else None,
+                "frame": to_number(block.get("frame"), int),
+                "fps": to_number(block.get("fps")),
+                "bitrate": to_number(block.get("bitrate", "").replace(
+                        "kbits/s", "")),
+                "total_size": to_number(block.get("total_size"), int),
+                "dup_frames": to_number(block.get("dup_frames"), int),
+                "drop_frames": to_number(block.get("drop_frames"), int),
+                "speed": to_number(block.get("speed", "").rstrip("x")),
+                "progress": v,
+                }
+        block = {}
+        yield info
+
+def progress_eta(info, total):
+    """
+    return a string of the speed and ETA.
+    info: a dict from iter_progress().
+    total: total duration in seconds.
+    """
+    speed = info.get("speed")
+    t = info.get("time")
+    if not speed or t is None:
+        return "x?.?? ETA ?:??:??"
+    eta = max(total - t, 0) / speed
+    return "x{:.2f} ETA {}".format(speed, timedelta(seconds=round(eta)))
+
+class Telemetry():
+
+    def __init__(self, path, **fields):
+        """
+        append records to the path in NDJSON.  it is thread safe.
+        fields: added into all records, in addition to ts and host.
+        """
+        import socket
+        self.fd = open(path, "a")
+        self.fields = {"host": socket.gethostname(), **fields}
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, record):
+        line = json.dumps({"ts": time.time(), **self.fields, **record})
+        with self.lock:
+            if not self.fd.closed:
+                self.fd.write(line + "\n")
+                self.fd.flush()
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
+def progress_bar(a, b, width=70, suffix=""):
     # "[" + "="*width + "]"
+    if suffix:
+        suffix = " " + suffix
     if b != 0:
-        bar = "="*int(a/b*width)
-        sys.stdout.write("\r[{}] {:3}%".format(bar.ljust(width), int(a/b*100)))
+        bar = "="*int(min(a/b,1)*width)
+        sys.stdout.write("\r[{}] {:3}%{}".format(bar.ljust(width),
+                                                 int(min(a/b,1)*100), suffix))
     else:
-        sys.stdout.write("\r[{}] {:3}%".format("="*width, "???"))
+        sys.stdout.write("\r[{}] {:3}%{}".format("="*width, "???", suffix))
     if a == b:
         sys.stdout.write("\n")
     sys.stdout.flush()
 
+class MultiProgress():
+
+    def __init__(self, width=40, interval=0.2):
+        """
+        progress bars of multiple jobs, one line for each running job.
+        the lines are redrawn in place.  it is thread safe.
+        interval: minimum interval in seconds to redraw.
+        """
+        self.width = width
+        self.interval = interval
+        self.bars = OrderedDict()
+        self.finished = []
+        self.nb_lines = 0
+        self.last_draw = 0
+        self.lock = threading.Lock()
+
+    def update(self, name, a, b, suffix=""):
+        with self.lock:
+            self.bars[name] = (a, b, suffix)
+            if time.monotonic() - self.last_draw >= self.interval:
+                self._draw()
+
+    def done(self, name, status):
+        with self.lock:
+            self.bars.pop(name, None)
+            self.finished.append(f"{status}: {name}")
+            self._draw()
+
+    def _draw(self):
+        columns = get_terminal_size((80,0)).columns
+        if self.nb_lines:
+            sys.stdout.write(f"\033[{self.nb_lines}F")
+        for line in self.finished:
+            sys.stdout.write(f"\033[K{line}\n")
+        self.finished = []
+        for name,(a,b,suffix) in self.bars.items():
+            ratio = min(a/b, 1) if b else 0
+            bar = "="*int(ratio*self.width)
+            line = "[{}] {:3}% {} {}".format(bar.ljust(self.width),
+                                             int(ratio*100), suffix, name)
+            sys.stdout.write("\033[K{}\n".format(line[:columns-1]))
+        # clear the lines left by the bars removed.
+        sys.stdout.write("\033[J")
+        self.nb_lines = len(self.bars)
+        self.last_draw = time.monotonic()
+        sys.stdout.flush()
@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+
+# the events of inotify(7).
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+class Watcher():
+
+    def __init__(self, dirs, poll_interval=2., use_inotify=True):
+        """
+        watch the files put into the dirs, not into their subdirectories.
+        inotify is used on Linux.  otherwise, the dirs are polled.
+        """
+        self.dirs = [ os.path.abspath(d) for d in dirs ]
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.wds = {}
+        self.known = {}
+        if use_inotify:
+            try:
+                self._init_inotify()
+            except (OSError, AttributeError) as e:
+                print(f"WARNING: inotify is not available, polling. {e}",
+                      file=sys.stderr)
+                self.fd = None
+
+    def _init_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        for d in self.dirs:
+            wd = libc.inotify_add_watch(
+                    fd, os.fsencode(d),
+                    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(err, f"inotify_add_watch {d}")
+            self.wds[wd] = d
+        self.fd = fd
+
+    @property
+    def mode(self):
+        return "polling" if self.fd is None else "inotify"
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def list_files(self):
+        """
+        return all the files in the dirs.
+        """
+        files = []
+        for d in self.dirs:
+            with os.scandir(d) as fd:
+                files.extend([ e.path for e in fd if e.is_file() ])
+        return files
+
+    def wait(self, timeout):
+        """
+        return a set of the files created or changed, waiting at most
+        timeout seconds.
+        """
+        if self.fd is None:
+            return self._poll(timeout)
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return set()
+        try:
+            buf = os.read(self.fd, 1<<16)
+        except BlockingIOError:
+            return set()
+        paths = set()
+        i = 0
+        while i + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(buf, i)
+            i += _EVENT_HEADER.size
+            name = buf[i:i+name_len].rstrip(b"\0")
+            i += name_len
+            if mask & IN_Q_OVERFLOW:
+                # some events are lost.
+                paths.update(self.list_files())
+            elif name and wd in self.wds:
+                paths.add(os.path.join(self.wds[wd], os.fsdecode(name)))
+        return paths
+
+    def _poll(self, timeout):
+        """
+        return the files of which size or mtime changed since the last call.
+        """
+        current = {}
+        for path in self.list_files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            current[path] = (st.st_size, st.st_mtime_ns)
+        changed = set([ p for p,v in current.items()
+                        if self.known.get(p) != v ])
+        self.known = current
+        if not changed:
+            time.sleep(min(timeout, self.poll_interval))
+        return changed